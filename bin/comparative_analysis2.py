@@ -101,6 +101,7 @@ def load_data(args):
         query_labels = query_data.get_labels()
         db_labels = db_data.get_labels()
         db_cell_ids = db_data.get_cell_ids()
+        query_cell_ids = query_data.get_cell_ids()
         data = {
                 'query_datacontainer': query_data,
                 'db_datacontainer': db_data,
@@ -109,6 +110,7 @@ def load_data(args):
                 'query_labels': query_labels,
                 'db_labels': db_labels,
                 'db_cell_ids': db_cell_ids,
+                'query_cell_ids': query_cell_ids,
                 }
         return data
 
@@ -467,13 +469,14 @@ def investigate_macrophage(data, reduced_query, macrophage_indices, macrophage_l
         macrophage_sym = []
         for mac, symb in macVsGlia_ens2symbol.items():
                 if mac in mouse_ens2enz:
-                        macrophage_enz.append(mouse_ens2enz[mac])
+                        # gene ids (columns) are strings
+                        macrophage_enz.append(str(mouse_ens2enz[mac]))
                         macrophage_sym.append(symb)
         microglia_enz = []
         microglia_sym = []
         for glia, symb in gliaVsMac_ens2symbol.items():
                 if glia in mouse_ens2enz:
-                        microglia_enz.append(mouse_ens2enz[glia])
+                        microglia_enz.append(str(mouse_ens2enz[glia]))
                         microglia_sym.append(symb)
         hits_df = data.iloc[macrophage_indices,:]
         plot_macrophage_two_axis(hits_df, macrophage_labels, macrophage_enz, microglia_enz, working_dir)
@@ -522,7 +525,7 @@ def main(args):
                 sorted_labels = data['db_labels'][sorted_distances_indices]
                 sorted_cell_ids = data['db_cell_ids'][sorted_distances_indices]
 
-                top_5_nearest_cells[data['query_datacontainer'].splits['train']['rpkm_df'].index[index]] = sorted_cell_ids[:5]
+                top_5_nearest_cells[data['query_cell_ids'][index]] = sorted_cell_ids[:5]
                 
                 min_distances = nearest_dist_to_each_type(sorted_distances, sorted_labels)
                 for db_type, min_dist in min_distances.items():
@@ -550,7 +553,9 @@ def main(args):
         make_5_nearest_distances_plots(avg_nearest_5_distances_dict, working_dir)
         make_classification_histograms(classifications, working_dir, config)
 
-        investigate_macrophage(data['query_datacontainer'].splits['train']['rpkm_df'], query_model, macrophage_indices, macrophage_labels, working_dir, overall_classifications)
+        query_df = pd.DataFrame(data['original_query'], index=data['query_cell_ids'],
+                                columns=data['query_datacontainer'].get_gene_ids())
+        investigate_macrophage(query_df, query_model, macrophage_indices, macrophage_labels, working_dir, overall_classifications)
         top_fibroblast = sorted(set(top_fibroblast))
         for f in top_fibroblast:
                 print(f)
@@ -1,98 +1,330 @@
 # import pdb; pdb.set_trace()
+import pickle
+import threading
 import time
 from collections import defaultdict
-from os import makedirs
-from os.path import join, exists
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from os.path import isdir, join
 
 import numpy as np
 import pandas as pd
-from keras.utils import np_utils, Sequence
-from sklearn.preprocessing import MinMaxScaler
+from keras.utils import Sequence
+from scipy import sparse
 
+from . import normalization
+from . import shared
 from . import siamese
+from .row_blocks import HDF5_LOCK, RowBlockMatrix, ShardedRowMatrix, is_sharded, list_shards, read_expression_mat, read_matrix_shape, read_sharded_expression_mat, take_rows
+from .. import util
+from ..util import cache
+
+# Per-split metadata stored alongside the expression matrix in cache entries
+CACHED_METADATA = ['labels_series', 'gene_symbols_series', 'accessions_series', 'true_ids_series', 'cell_ids', 'gene_ids']
+# Per-cell metadata, concatenated across the shards of a sharded split
+PER_CELL_METADATA = ['labels_series', 'accessions_series', 'true_ids_series']
+
+
+def get_split_path(data_dir, split_name):
+    """A split is either a single HDF5 file (e.g. 'train_data.h5') or a
+    directory of HDF5 shards (e.g. 'train_data/').
+    """
+    shard_dir = join(data_dir, split_name)
+    if isdir(shard_dir):
+        return shard_dir
+    return join(data_dir, split_name + '.h5')
+
+
+def read_split_metadata(filepath):
+    """Read the metadata series of a split, which is either a single HDF5
+    file or a directory of HDF5 shards (whose metadata is concatenated in
+    shard order).
+    """
+    shard_paths = list_shards(filepath) if is_sharded(filepath) else [filepath]
+    shard_metadata = []
+    for shard_path in shard_paths:
+        with HDF5_LOCK:
+            h5_store = pd.HDFStore(shard_path, mode='r')
+            shard_metadata.append({
+                'labels_series': h5_store['labels'] if 'labels' in h5_store else None,
+                'gene_symbols_series': h5_store['gene_symbols'] if 'gene_symbols' in h5_store else None,
+                'accessions_series': h5_store['accessions'] if 'accessions' in h5_store else None,
+                'true_ids_series': h5_store['true_ids'] if 'true_ids' in h5_store else None})
+            h5_store.close()
+    metadata = shard_metadata[0]
+    if len(shard_metadata) > 1:
+        for key in PER_CELL_METADATA:
+            if metadata[key] is not None:
+                metadata[key] = pd.concat([m[key] for m in shard_metadata])
+    return metadata
 
 
 class DataContainer(object):
-    """Parses and holds the input data table (gene expression file) in memory
-    and provides access to various aspects of it.
+    """Parses and holds the input data table (gene expression file) and
+    provides access to various aspects of it. Splits (HDF5 files or directories
+    of shards) are loaded and normalized lazily, or in background threads if
+    load_async is True.
     """
-    def __init__(self, filepath, sample_normalize=False, feature_normalize=False, feature_mean=None, feature_std=None, minmax_normalize=False, min=-1, max=1, minmax_scaler=None):
-        self.sample_normalize = sample_normalize
-        self.feature_normalize = feature_normalize
-        self.mean = feature_mean
-        self.std = feature_std
-        self.minmax_normalize = minmax_normalize
-        self.min = min
-        self.max = max
-        self.minmax_scaler = minmax_scaler
+    def __init__(self, filepath, normalizer=None, block_size=None, cache=None, as_sparse=False, load_async=False):
+        self.normalizer = normalizer if normalizer is not None else normalization.Normalizer()
+        self.block_size = block_size
+        self.cache = cache
+        self.as_sparse = as_sparse
+        if self.as_sparse and self.normalizer.requires_fit:
+            raise util.ScrnaException("Only sample normalization is supported for sparse data (feature and minmax normalization would make it dense)!")
+        if self.as_sparse and self.block_size is not None:
+            raise util.ScrnaException("Sparse data cannot also be read out-of-core!")
         self.splits = defaultdict(dict)
-        self.add_split(filepath, 'train')
         self.label_to_int_map = None
+        self.label_classes = None
+        self._paths = {}
+        self._pending = {}
+        self._load_lock = threading.RLock()
+        self._executor = ThreadPoolExecutor(max_workers=3) if load_async else None
+        self.add_split(filepath, 'train')
 
     def _create_label_mapping(self):
         # Create a unique mapping of label string to integer, will be shared among all splits
-        label_strings = self.splits['train']['labels_series'].values
-        uniq_label_strings, y = np.unique(label_strings, return_inverse=True)
-        self.label_to_int_map = {}
-        for i, label_string in enumerate(label_strings):
-            self.label_to_int_map[label_string] = y[i]
-    
-    def _normalize_split(self, split):
-        eps = np.finfo(np.float32).eps
-        if self.sample_normalize:
-            print("sample normalizing...")
-            t0 = time.time()
-            self.splits[split]['rpkm_df'] = self.splits[split]['rpkm_df'].div(self.splits[split]['rpkm_df'].sum(axis=1) + eps, axis=0)
-            print("time to normalize: ", time.time() - t0)
-        elif self.feature_normalize:
-            print("feature normalizing...")
-            t0 = time.time()
-            if split == 'train' and self.mean is None and self.std is None: # stats should already be in place for valid/test splits
-                self.mean = self.splits[split]['rpkm_df'].mean()
-                self.std = self.splits[split]['rpkm_df'].std(ddof=0)
-            self.splits[split]['rpkm_df'] = (self.splits[split]['rpkm_df'] - self.mean) / (self.std + eps)
-            print("time to normalize: ", time.time() - t0)
-        elif self.minmax_normalize:
-            print("minmax normalizing...")
+        self.label_classes = np.unique(self.get_labels('train'))
+        self.label_to_int_map = {label_string: i for i, label_string in enumerate(self.label_classes)}
+
+    def _fit_normalizer(self, split, chunks):
+        # Statistics are only fit on the train split, they should already be
+        # in place for valid/test splits
+        if split == 'train' and not self.normalizer.is_fitted:
             t0 = time.time()
-            if split == 'train' and self.minmax_scaler is None:
-                self.minmax_scaler = MinMaxScaler(feature_range=(self.min, self.max))
-                self.minmax_scaler.fit(self.splits[split]['rpkm_df'].values)
-            self.splits[split]['rpkm_df'].iloc[:,:] = self.minmax_scaler.transform(self.splits[split]['rpkm_df'].values)
-            print("min = {}".format(np.amin(self.splits[split]['rpkm_df'].values)))
-            print("max = {}".format(np.amax(self.splits[split]['rpkm_df'].values)))
-            print("time to normalize: ", time.time() - t0)
-            
+            self.normalizer.fit(chunks)
+            print("time to compute statistics: ", time.time() - t0)
+
+    def _normalize_split(self, split):
+        # Normalizations are applied in place on the float32 expression matrix
+        if self.normalizer.method == 'none':
+            return
+        X = self.splits[split]['expression']
+        print("normalizing ({})...".format(self.normalizer.method))
+        t0 = time.time()
+        if self.normalizer.requires_fit:
+            self._fit_normalizer(split, normalization.iter_row_chunks(X))
+        self.normalizer.transform(X)
+        print("time to normalize: ", time.time() - t0)
+
+    def _normalize_split_blocks(self, split):
+        # Same normalization as _normalize_split, but for a RowBlockMatrix:
+        # statistics are accumulated over the blocks of the train split, and
+        # the normalization is applied to each block when it is read.
+        if self.normalizer.method == 'none':
+            return
+        matrix = self.splits[split]['expression']
+        print("normalizing ({}) per block...".format(self.normalizer.method))
+        if self.normalizer.requires_fit:
+            self._fit_normalizer(split, matrix.iter_blocks(raw=True))
+        matrix.transform = self.normalizer.transform
+
+    @staticmethod
+    def _content_hash(cache_manager, filepath):
+        # Sharded splits are identified by the contents of each of their shards
+        if is_sharded(filepath):
+            return [cache_manager.content_hash(shard_path) for shard_path in list_shards(filepath)]
+        return cache_manager.content_hash(filepath)
+
+    def _cache_key(self, filepath, split):
+        # The normalized matrix depends on the input file, the normalization,
+        # and the statistics used (if they are not fitted on this split)
+        content_hash = self._content_hash(self.cache, filepath)
+        return cache.hash_parts(content_hash, 'csr' if self.as_sparse else 'dense', *self.normalizer.state())
+
+    def _save_split_to_cache(self, split, path):
+        X = self.splits[split]['expression']
+        if isinstance(X, RowBlockMatrix):
+            # Stream the normalized blocks to disk
+            out = np.lib.format.open_memmap(join(path, 'X.npy'), mode='w+', dtype=np.float32, shape=X.shape)
+            for block_idx, block in enumerate(X.iter_blocks()):
+                start, stop = X.block_bounds(block_idx)
+                out[start:stop] = block
+            out.flush()
+            del out
+        elif sparse.issparse(X):
+            # Store the CSR arrays separately so they can each be memory-mapped
+            np.save(join(path, 'X_data.npy'), X.data)
+            np.save(join(path, 'X_indices.npy'), X.indices)
+            np.save(join(path, 'X_indptr.npy'), X.indptr)
+            with open(join(path, 'X_shape.pickle'), 'wb') as f:
+                pickle.dump(X.shape, f)
+        else:
+            np.save(join(path, 'X.npy'), X)
+        metadata = {key: self.splits[split].get(key) for key in CACHED_METADATA}
+        if isinstance(X, RowBlockMatrix):
+            metadata['cell_ids'] = X.index
+            metadata['gene_ids'] = X.columns
+        with open(join(path, 'metadata.pickle'), 'wb') as f:
+            pickle.dump(metadata, f)
+        self.normalizer.save(path)
+
+    def _load_split_from_cache(self, split, path):
+        t0 = time.time()
+        with open(join(path, 'metadata.pickle'), 'rb') as f:
+            self.splits[split].update(pickle.load(f))
+        # Restore statistics that were fitted when the entry was created
+        if not self.normalizer.is_fitted:
+            self.normalizer.copy_stats_from(normalization.Normalizer.load(path))
+        if self.as_sparse:
+            with open(join(path, 'X_shape.pickle'), 'rb') as f:
+                shape = pickle.load(f)
+            self.splits[split]['expression'] = sparse.csr_matrix(
+                (np.load(join(path, 'X_data.npy'), mmap_mode='r'),
+                 np.load(join(path, 'X_indices.npy'), mmap_mode='r'),
+                 np.load(join(path, 'X_indptr.npy'), mmap_mode='r')),
+                shape=shape, copy=False)
+        else:
+            self.splits[split]['expression'] = np.load(join(path, 'X.npy'), mmap_mode='r')
+        print("loaded {} from cache in {:.3f}s".format(self.splits[split]['expression'].shape, time.time() - t0))
+
     def add_split(self, filepath, split):
+        """Register a split. Nothing is read until the split's metadata or
+        expression matrix is first accessed, unless splits are loaded in the
+        background (load_async), in which case loading starts right away.
+        """
+        with self._load_lock:
+            self._paths[split] = filepath
+            if self._executor is not None:
+                # Metadata is small and is read right away, so that labels and
+                # dimensions are available while the expression matrix is loading
+                self._ensure_metadata(split)
+                self._pending[split] = self._executor.submit(self._load_split, filepath, split)
+
+    def get_split_names(self):
+        return list(self._paths.keys())
+
+    def _ensure_metadata(self, split):
+        with self._load_lock:
+            if 'shape' in self.splits[split]:
+                return
+            if split != 'train':
+                self._ensure_metadata('train')
+            filepath = self._paths[split]
+            self.splits[split].update(read_split_metadata(filepath))
+            self.splits[split]['shape'] = read_matrix_shape(filepath, 'rpkm')
+            if split != 'train':
+                assert (np.array_equal(self.splits['train']['gene_symbols_series'].values, self.splits[split]['gene_symbols_series'].values)), 'New split does not have same columns as rest of data!'
+
+    def _ensure_loaded(self, split):
+        # Load the split's expression matrix on first access (or wait for
+        # it to finish loading in the background)
+        with self._load_lock:
+            self._ensure_metadata(split)
+            if 'expression' not in self.splits[split]:
+                if self._executor is None:
+                    self._load_split(self._paths[split], split)
+                elif split not in self._pending:
+                    self._pending[split] = self._executor.submit(self._load_split, self._paths[split], split)
+        self.wait_for_split(split)
+
+    def wait_for_split(self, split):
+        """Block until the split has finished loading in the background
+        (re-raising any error that occurred while loading it).
+        """
+        future = self._pending.get(split)
+        if future is not None:
+            future.result()
+
+    def on_split_loaded(self, split, fcn):
+        """Call fcn() once the split has loaded (right away if it is not
+        being loaded in the background).
+        """
+        future = self._pending.get(split)
+        if future is None:
+            fcn()
+        else:
+            future.add_done_callback(lambda f: fcn() if f.exception() is None else None)
+
+    def release_split(self, split):
+        """Free the expression matrix of a split (and data derived from it),
+        e.g. once it is no longer needed in a long pipeline. Its metadata is
+        kept, and the matrix is loaded again if it is accessed later.
+        """
+        self.wait_for_split(split)
+        with self._load_lock:
+            self._pending.pop(split, None)
+            split_data = self.splits[split]
+            X = split_data.pop('expression', None)
+            if isinstance(X, RowBlockMatrix):
+                X.close()
+            for key in ['cell_ids', 'gene_ids', 'siam_pairs', 'siam_y']:
+                split_data.pop(key, None)
+
+    def _wait_for_normalizer(self, split):
+        # Other splits are normalized with the statistics fit on train, so
+        # train must be loaded first unless the statistics were given
+        if split != 'train' and ('train' in self._pending or not self.normalizer.is_fitted):
+            self._ensure_loaded('train')
+
+    def get_fitted_normalizer(self):
+        if 'train' in self._pending or not self.normalizer.is_fitted:
+            self._ensure_loaded('train')
+        return self.normalizer
+
+    def _load_split(self, filepath, split):
+        if self.cache is not None:
+            # Hash the input (often as slow as reading it) before waiting
+            self._content_hash(self.cache, filepath)
+            self._wait_for_normalizer(split)
+            key = self._cache_key(filepath, split)
+            path = self.cache.get(key)
+            if path is not None:
+                print('Reading in cached data for ', filepath)
+                self._load_split_from_cache(split, path)
+                return
+        self._read_split(filepath, split)
+        if self.cache is not None:
+            print('Caching normalized data for ', filepath)
+            path = self.cache.put(key, lambda path: self._save_split_to_cache(split, path))
+            if isinstance(self.splits[split]['expression'], RowBlockMatrix):
+                # The cached copy is already normalized and can be memory-mapped
+                self.splits[split]['expression'].close()
+                self._load_split_from_cache(split, path)
+
+    def _read_split(self, filepath, split):
         print('Reading in data from ', filepath)
-        h5_store = pd.HDFStore(filepath)
-        self.splits[split]['rpkm_df'] = h5_store['rpkm']
-        self.splits[split]['labels_series'] = h5_store['labels'] if 'labels' in h5_store else None
-        self.splits[split]['gene_symbols_series'] = h5_store['gene_symbols'] if 'gene_symbols' in h5_store else None
-        if split != 'train':
-            assert (np.array_equal(self.splits['train']['gene_symbols_series'].values, self.splits[split]['gene_symbols_series'].values)), 'New split does not have same columns as rest of data!'
-        self.splits[split]['accessions_series'] = h5_store['accessions'] if 'accessions' in h5_store else None
-        self.splits[split]['true_ids_series'] = h5_store['true_ids'] if 'true_ids' in h5_store else None
-        h5_store.close()
-        self.splits[split]['rpkm_df'].fillna(0, inplace=True) # Worries me that we have to do this...
-        # Convert numeric to float32 for deep learning libraries
-        self.splits[split]['rpkm_df'] = self.splits[split]['rpkm_df'].apply(pd.to_numeric, errors='ignore', downcast='float')
-        print("converted to float32")
-        # Ensure the column names are stored as strings for campatability
-        self.splits[split]['rpkm_df'].columns = self.splits[split]['rpkm_df'].columns.astype(str)
+        if self.block_size is not None:
+            print("Reading lazily in blocks of {} rows".format(self.block_size))
+            if is_sharded(filepath):
+                self.splits[split]['expression'] = ShardedRowMatrix(list_shards(filepath), 'rpkm', self.block_size)
+            else:
+                self.splits[split]['expression'] = RowBlockMatrix(filepath, 'rpkm', self.block_size)
+            self._wait_for_normalizer(split)
+            self._normalize_split_blocks(split)
+            return
+        t0 = time.time()
+        # Read directly into a single float32 matrix (missing values are filled
+        # with 0 during the read). The cell ids (index) and gene ids (columns,
+        # stored as strings for compatibility) are kept separately.
+        if is_sharded(filepath):
+            X, cell_ids, gene_ids = read_sharded_expression_mat(list_shards(filepath), 'rpkm', as_sparse=self.as_sparse)
+        else:
+            X, cell_ids, gene_ids = read_expression_mat(filepath, 'rpkm', as_sparse=self.as_sparse)
+        self.splits[split]['expression'] = X
+        self.splits[split]['cell_ids'] = cell_ids
+        self.splits[split]['gene_ids'] = gene_ids
+        print("loaded {} float32 {}matrix in {:.2f}s (peak RSS: {} MB)".format(X.shape, "sparse " if self.as_sparse else "", time.time() - t0, util.peak_rss_mb()))
+        self._wait_for_normalizer(split)
         self._normalize_split(split)
-    
+
+    def get_metadata(self, key, split='train'):
+        """A metadata series of a split (e.g. 'labels_series')."""
+        self._ensure_metadata(split)
+        return self.splits[split][key]
+
     def get_gene_names(self):
-        return self.splits['train']['gene_symbols_series'].values
+        return self.get_metadata('gene_symbols_series').values
 
     def get_dataset_IDs(self, split):
-        return self.splits[split]['accessions_series'].values
+        return self.get_metadata('accessions_series', split).values
 
     def get_labels(self, split='train'):
-        return self.splits[split]['labels_series'].values
+        return self.get_metadata('labels_series', split).values
 
     def get_true_ids(self, split='train'):
-        return self.splits[split]['true_ids_series'].values
+        return self.get_metadata('true_ids_series', split).values
 
     # def get_data(self):
     #     expression_mat = self.rpkm_df.values
@@ -101,33 +333,58 @@ class DataContainer(object):
     #     return expression_mat, labels_as_int, uniq_label_strings
 
     def get_expression_mat(self, split='train'):
-        return self.splits[split]['rpkm_df'].values
+        self._ensure_loaded(split)
+        return self.splits[split]['expression']
 
     def get_cell_ids(self, split='train'):
-        return self.splits[split]['rpkm_df'].index.values
+        self._ensure_loaded(split)
+        if isinstance(self.splits[split]['expression'], RowBlockMatrix):
+            return self.splits[split]['expression'].index.values
+        return self.splits[split]['cell_ids'].values
 
-    def get_data_for_neural_net(self, split, one_hot=True):
-        if self.label_to_int_map is None:
-            self._create_label_mapping()
-        X = self.splits[split]['rpkm_df'].values
-        label_strings = self.splits[split]['labels_series'].values
-        y = []
-        for label in label_strings:
-            y.append(self.label_to_int_map[label])
-        output_dim = len(self.label_to_int_map)
-        if one_hot:
-            y = np_utils.to_categorical(y, output_dim)
-        return X, y
-
-    def get_data_for_neural_net_unsupervised(self, split, noise_level):
-        X_clean = self.splits[split]['rpkm_df'].values
-        X = X_clean + noise_level * np.random.normal(loc=0, scale=1, size=X_clean.shape)
-        return X, X_clean
+    def get_gene_ids(self, split='train'):
+        self._ensure_loaded(split)
+        if isinstance(self.splits[split]['expression'], RowBlockMatrix):
+            return self.splits[split]['expression'].columns.values
+        return self.splits[split]['gene_ids'].values
+
+    def share_split(self, split='train'):
+        """Move the in-memory expression matrix of a split into a shared
+        matrix, which Sequences hand to worker processes by name instead of
+        pickling it (memory-mapped, e.g. cached, matrices are already shared).
+        Out-of-core and sparse matrices are left as they are.
+        """
+        X = self.get_expression_mat(split)
+        if isinstance(X, np.ndarray) and shared.get_handle(X) is None:
+            self.splits[split]['expression'] = shared.from_array(X)
+
+    def get_label_ids(self, split='train'):
+        """The labels of a split as int32 ids (the same for every split, see
+        label_to_int_map). Computed once per split.
+        """
+        if 'label_ids' not in self.splits[split]:
+            if self.label_to_int_map is None:
+                self._create_label_mapping()
+            label_strings = np.asarray(self.get_labels(split))
+            label_ids = np.searchsorted(self.label_classes, label_strings)
+            unknown = (label_ids == len(self.label_classes)) | (self.label_classes[np.minimum(label_ids, len(self.label_classes) - 1)] != label_strings)
+            if unknown.any():
+                raise util.ScrnaException("Labels not present in the training data: {}".format(np.unique(label_strings[unknown])))
+            self.splits[split]['label_ids'] = label_ids.astype(np.int32)
+        return self.splits[split]['label_ids']
+
+    def get_data_for_neural_net(self, split):
+        """The expression matrix and int32 label ids of a split (classifiers
+        are trained with a sparse categorical loss, so no one-hot matrix is
+        built).
+        """
+        return self.get_expression_mat(split), self.get_label_ids(split)
 
     def get_in_out_dims(self):
         if self.label_to_int_map is None:
             self._create_label_mapping()
-        return self.splits['train']['rpkm_df'].shape[1], len(self.label_to_int_map)
+        self._ensure_metadata('train')
+        return self.splits['train']['shape'][1], len(self.label_to_int_map)
     # def save_about_data(self, folder_to_save_in):
     #     """Save some descriptive info about this data to a text file.
     #     """
@@ -139,59 +396,264 @@ class DataContainer(object):
     #         f.write("\nCount for each label:\n")
     #         f.write(str(counts) + "\n")
 
-    def _create_siamese_data_split(self, args, split):
-        CACHE_ROOT = '_cache'
-        SIAM_CACHE = 'siam_data'
-        # First check if we have already cached the siamese data for this configuration
-        # Build a configuration string (a string that uniquely identifies a configuration)
-        normalization = ""
-        if args.sn:
-            normalization = "sn"
-        elif args.gn:
-            normalization = "gn"
-        config_string = '_'.join([args.data, normalization, args.dynMarginLoss, args.dist_mat_file, args.trnsfm_fcn, str(args.trnsfm_fcn_param), str(args.unif_diff), str(args.same_lim), str(args.diff_multiplier)])
-        cache_path = join(join(join(CACHE_ROOT, SIAM_CACHE), config_string), split)
-        if exists(cache_path):
+    def _siamese_cache_key(self, pairs_cache, args, split):
+        # Pairs are row indices, so they depend on the contents of the input
+        # (but not on its normalization), the similarity matrix, and the
+        # pair-generation parameters
+        content_hash = self._content_hash(pairs_cache, self._paths[split])
+        dist_mat_hash = pairs_cache.content_hash(args.dist_mat_file)
+        return cache.hash_parts(content_hash, dist_mat_hash, args.dynMarginLoss, args.max_ont_dist,
+                                args.trnsfm_fcn, args.trnsfm_fcn_param, args.unif_diff,
+                                args.same_lim, args.diff_multiplier)
+
+    def _save_siamese_data_to_cache(self, split, path):
+        np.save(join(path, "siam_pairs.npy"), self.splits[split]['siam_pairs'])
+        np.save(join(path, "siam_y.npy"), self.splits[split]['siam_y'])
+
+    def _create_siamese_data_split(self, args, split, pairs_cache):
+        key = self._siamese_cache_key(pairs_cache, args, split)
+        path = pairs_cache.get(key)
+        if path is not None:
             print("Loading siamese data from cache...")
-            siam_X = np.load(join(cache_path, "siam_X.npy"))
-            print('Siamese X shape:')
-            print(siam_X.shape)
-            self.splits[split]['siam_X'] = [ siam_X[:, 0], siam_X[:, 1] ]
-            self.splits[split]['siam_y'] = np.load(join(cache_path, "siam_y.npy"))
+            self.splits[split]['siam_pairs'] = np.load(join(path, "siam_pairs.npy"))
+            self.splits[split]['siam_y'] = np.load(join(path, "siam_y.npy"))
         else:
             # If cached data doesn't exist, we have to make it
             X = self.get_expression_mat(split)
-            uniq_label_strings, y = np.unique(self.splits[split]['labels_series'].values, return_inverse=True)
-            siam_X, siam_y = siamese.create_flexible_data_pairs(X, y, self.get_true_ids(split), uniq_label_strings, args)
-            print('Siamese X shape:')
-            print(siam_X.shape)
-            self.splits[split]['siam_X'] = [ siam_X[:, 0], siam_X[:, 1] ]
+            uniq_label_strings, y = np.unique(self.get_labels(split), return_inverse=True)
+            siam_pairs, siam_y = siamese.create_flexible_data_pairs(X, y, self.get_true_ids(split), uniq_label_strings, args, args.pair_workers)
+            self.splits[split]['siam_pairs'] = siam_pairs
             self.splits[split]['siam_y'] = siam_y
-            makedirs(cache_path)
-            np.save(join(cache_path, "siam_X"), siam_X)
-            np.save(join(cache_path, "siam_y"), siam_y)
+            pairs_cache.put(key, lambda path: self._save_siamese_data_to_cache(split, path))
+        print('Siamese pairs shape:')
+        print(self.splits[split]['siam_pairs'].shape)
+
+    def get_siamese_data(self, split):
+        """(expression matrix, pairs of row indices, pair similarities) of a
+        split, see create_siamese_data. For a split whose pairs are resampled
+        (see create_pair_sampler), one epoch's worth of pairs is drawn.
+        """
+        if 'siam_pairs' not in self.splits[split] and 'pair_sampler' in self.splits[split]:
+            siam_pairs, siam_y = self.splits[split]['pair_sampler'].draw_epoch()
+            return self.get_expression_mat(split), siam_pairs, siam_y
+        return self.get_expression_mat(split), self.splits[split]['siam_pairs'], self.splits[split]['siam_y']
     
-    def create_siamese_data(self, args):
-        for split in self.splits.keys():
-            self._create_siamese_data_split(args, split)
+    def create_siamese_data(self, args, splits=None):
+        pairs_cache = cache.get_siamese_cache(args)
+        for split in splits or self.get_split_names():
+            self._create_siamese_data_split(args, split, pairs_cache)
 
-class ExpressionSequence(Sequence):
-    def __init__(self, x_set, y_set, batch_size, name, shuffle=True):
+    def get_siamese_labels(self, args, split='train'):
+        """The split's labels as integer ids, and the compiled similarity
+        between every pair of label ids.
+        """
+        uniq_label_strings, y = np.unique(self.get_labels(split), return_inverse=True)
+        return y, siamese.compile_similarity(uniq_label_strings, args)
+
+    def create_pair_sampler(self, args, split='train'):
+        """A PairSampler that draws new siamese pairs for the split every
+        epoch (no pairs are generated or cached up front).
+        """
+        y, similarity = self.get_siamese_labels(args, split)
+        sampler = siamese.PairSampler(y, self.get_true_ids(split), similarity, args)
+        self.splits[split]['pair_sampler'] = sampler
+        return sampler
+
+class SeededSequence(Sequence):
+    """A Sequence whose batch idx of each epoch draws from its own
+    RandomState, so batches are reproducible when built out of order by workers.
+    """
+    def __init__(self, seed=None):
+        self.seed = np.random.randint(2**31 - 1) if seed is None else seed
+        self.epoch = 0
+
+    def __getstate__(self):
+        # Shared matrices are passed to worker processes by their handle
+        state = self.__dict__.copy()
+        for key, value in state.items():
+            handle = shared.get_handle(value)
+            if handle is not None:
+                state[key] = handle
+        return state
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            if isinstance(value, shared.SharedHandle):
+                state[key] = shared.attach(value)
+        self.__dict__.update(state)
+
+    def batch_rng(self, idx):
+        return np.random.RandomState([self.seed, self.epoch, idx])
+
+    def on_epoch_end(self):
+        self.epoch += 1
+
+
+class ExpressionSequence(SeededSequence):
+    """Minibatches of the rows in rows (default all) of an expression matrix,
+    and their targets (if y_set is given), in a new random order every epoch.
+    Batch buffers are reused n_buffers batches later.
+    """
+    def __init__(self, x_set, y_set, batch_size, name, shuffle=True, n_buffers=4, rows=None):
+        super(ExpressionSequence, self).__init__()
         self.x = x_set
-        self.y = y_set
+        self.y = None if y_set is None else np.asarray(y_set)
+        self.start, self.stop, _ = (rows or slice(None)).indices(x_set.shape[0])
         self.batch_size = batch_size
         self.name = name
-        if shuffle:
-            idx_array = np.arange(self.x.shape[0])
-            np.random.shuffle(idx_array)
-            self.x = self.x[idx_array]
-            self.y = self.y[idx_array]
+        self.shuffle = shuffle
+        self.index_array = None
+        self.x_buffers = None
+        if isinstance(self.x, np.ndarray):
+            self.x_buffers = np.empty((n_buffers, batch_size) + self.x.shape[1:], dtype=self.x.dtype)
+        self.y_buffers = None
+        if self.y is not None:
+            self.y_buffers = np.empty((n_buffers, batch_size) + self.y.shape[1:], dtype=self.y.dtype)
+        self.n_buffers = n_buffers
+        self.buffer_counter = count()
+        self.shuffle_rows()
+
+    def shuffle_rows(self):
+        if not self.shuffle:
+            return
+        if isinstance(self.x, RowBlockMatrix):
+            # Shuffle the order in which rows of an out-of-core matrix are
+            # read block by block, to keep reads sequential
+            indices = self.x.block_shuffled_indices()
+            self.index_array = indices[(indices >= self.start) & (indices < self.stop)]
+        else:
+            self.index_array = self.start + np.random.permutation(self.stop - self.start)
+
+    def on_epoch_end(self):
+        super(ExpressionSequence, self).on_epoch_end()
+        self.shuffle_rows()
 
     def __len__(self):
-        return int(np.ceil(len(self.x) / float(self.batch_size)))
+        return int(np.ceil((self.stop - self.start) / float(self.batch_size)))
 
     def __getitem__(self, idx):
         # print("ExpressionSequence {} idx={}".format(self.name, idx))
-        batch_x = self.x[idx * self.batch_size:(idx + 1) * self.batch_size]
-        batch_y = self.y[idx * self.batch_size:(idx + 1) * self.batch_size]
+        if self.index_array is None:
+            # Slices of in-memory matrices are views, nothing to gather
+            batch = slice(self.start + idx * self.batch_size,
+                          min(self.start + (idx + 1) * self.batch_size, self.stop))
+            return take_rows(self.x, batch), None if self.y is None else self.y[batch]
+        batch = slice(idx * self.batch_size, (idx + 1) * self.batch_size)
+        batch_idx = self.index_array[batch]
+        buffer_idx = next(self.buffer_counter) % self.n_buffers
+        if self.x_buffers is not None:
+            batch_x = np.take(self.x, batch_idx, axis=0, out=self.x_buffers[buffer_idx, :len(batch_idx)])
+        else:
+            batch_x = take_rows(self.x, batch_idx)
+        if self.y is None:
+            return batch_x, None
+        batch_y = np.take(self.y, batch_idx, axis=0, out=self.y_buffers[buffer_idx, :len(batch_idx)])
+        return batch_x, batch_y
+
+
+def add_noise(X, noise_type, noise_level, rng=np.random):
+    """A corrupted float32 copy of X, for training denoising autoencoders:
+        'gaussian' - add zero-mean gaussian noise with std noise_level
+        'dropout' - set a random noise_level fraction of the entries to 0
+    """
+    if noise_type == 'gaussian':
+        noisy = rng.standard_normal(X.shape).astype(np.float32)
+        noisy *= noise_level
+        noisy += X
+        return noisy
+    elif noise_type == 'dropout':
+        return (X * (rng.random_sample(X.shape) >= noise_level)).astype(np.float32)
+    raise util.ScrnaException("Not a valid noise type: {}".format(noise_type))
+
+
+class DenoisingSequence(ExpressionSequence):
+    """Minibatches of (corrupted rows, clean rows) for training a denoising
+    autoencoder, with new noise drawn for every minibatch.
+    """
+    def __init__(self, x_set, batch_size, name, noise_type='gaussian', noise_level=0.1, shuffle=True, n_buffers=4, rows=None):
+        super(DenoisingSequence, self).__init__(x_set, None, batch_size, name, shuffle, n_buffers, rows)
+        self.noise_type = noise_type
+        self.noise_level = noise_level
+
+    def __getitem__(self, idx):
+        clean, _ = super(DenoisingSequence, self).__getitem__(idx)
+        return add_noise(clean, self.noise_type, self.noise_level, self.batch_rng(idx)), clean
+
+
+class SiamesePairSequence(SeededSequence):
+    """Minibatches of pairs for a siamese network, given as pairs of row
+    indices into X.
+    """
+    def __init__(self, X, pairs, y, batch_size, name, shuffle=True):
+        super(SiamesePairSequence, self).__init__()
+        self.x = X
+        self.pairs = pairs
+        self.y = y
+        self.batch_size = batch_size
+        self.name = name
+        self.index_array = np.random.permutation(len(pairs)) if shuffle else None
+        self.mined_pairs = None
+        self.next_mined = None
+
+    def set_mined_pairs(self, pairs, y, fraction):
+        """Starting with the next epoch the sequence begins, make up fraction
+        of every minibatch with pairs drawn from these (see HardPairMiner).
+        """
+        self.next_mined = (pairs, y, fraction)
+
+    def on_epoch_end(self):
+        super(SiamesePairSequence, self).on_epoch_end()
+        # Only switch pairs between epochs: Keras' enqueuer calls this before
+        # it hands the sequence to the workers for the next epoch
+        if self.next_mined is not None:
+            self.mined_pairs, self.mined_y, self.mined_fraction = self.next_mined
+            self.next_mined = None
+
+    def __len__(self):
+        return int(np.ceil(len(self.pairs) / float(self.batch_size)))
+
+    def __getitem__(self, idx):
+        batch = slice(idx * self.batch_size, (idx + 1) * self.batch_size)
+        if self.index_array is not None:
+            batch = self.index_array[batch]
+        batch_pairs, batch_y = self.pairs[batch], self.y[batch]
+        if self.mined_pairs is not None:
+            batch_pairs, batch_y = siamese.mix_in_pairs(batch_pairs, batch_y, self.mined_pairs, self.mined_y, self.mined_fraction, self.batch_rng(idx))
+        batch_x = [take_rows(self.x, batch_pairs[:, 0]), take_rows(self.x, batch_pairs[:, 1])]
         return batch_x, batch_y
+
+
+class ResampledPairSequence(SeededSequence):
+    """Minibatches of siamese pairs drawn by a PairSampler as they are
+    requested, so every epoch sees a new set of pairs.
+    """
+    def __init__(self, X, sampler, batch_size, name):
+        super(ResampledPairSequence, self).__init__()
+        self.x = X
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.name = name
+        self.sampler.shuffle()
+        self.mined_pairs = None
+        self.next_mined = None
+
+    def set_mined_pairs(self, pairs, y, fraction):
+        self.next_mined = (pairs, y, fraction)
+
+    def __len__(self):
+        return int(np.ceil(len(self.sampler) / float(self.batch_size)))
+
+    def __getitem__(self, idx):
+        rng = self.batch_rng(idx)
+        batch_pairs, batch_y = self.sampler.draw(slice(idx * self.batch_size, (idx + 1) * self.batch_size), rng)
+        if self.mined_pairs is not None:
+            batch_pairs, batch_y = siamese.mix_in_pairs(batch_pairs, batch_y, self.mined_pairs, self.mined_y, self.mined_fraction, rng)
+        batch_x = [take_rows(self.x, batch_pairs[:, 0]), take_rows(self.x, batch_pairs[:, 1])]
+        return batch_x, batch_y
+
+    def on_epoch_end(self):
+        super(ResampledPairSequence, self).on_epoch_end()
+        self.sampler.shuffle()
+        if self.next_mined is not None:
+            self.mined_pairs, self.mined_y, self.mined_fraction = self.next_mined
+            self.next_mined = None
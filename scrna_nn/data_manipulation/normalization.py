@@ -0,0 +1,236 @@
+import pickle
+from os.path import exists, join
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from ..util import ScrnaException
+
+FEATURE_MEAN_FILE = 'mean.npy'
+FEATURE_STD_FILE = 'std.npy'
+NORMALIZER_FILE = 'normalizer.npz'
+
+
+class RunningMoments(object):
+    """Per-gene (column) mean and variance, accumulated over chunks of rows
+    (Chan et al.'s pairwise update).
+    """
+    def __init__(self, n_features):
+        self.count = 0
+        self.mean = np.zeros(n_features, dtype=np.float64)
+        self.m2 = np.zeros(n_features, dtype=np.float64)
+
+    @classmethod
+    def from_chunk(cls, chunk):
+        moments = cls(chunk.shape[1])
+        moments.count = chunk.shape[0]
+        if moments.count > 0:
+            moments.mean = chunk.mean(axis=0, dtype=np.float64)
+            moments.m2 = np.square(chunk - moments.mean).sum(axis=0)
+        return moments
+
+    def merge(self, other):
+        """Combine the moments of another set of rows into these ones."""
+        if other.count == 0:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * (other.count / count)
+        self.m2 += other.m2 + np.square(delta) * (self.count * other.count / count)
+        self.count = count
+        return self
+
+    def update(self, chunk):
+        return self.merge(RunningMoments.from_chunk(chunk))
+
+    @property
+    def variance(self):
+        # Population variance (ddof=0)
+        return self.m2 / max(self.count, 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+
+def iter_row_chunks(X, chunk_rows=10000):
+    """Yield views of consecutive chunks of rows of an in-memory matrix."""
+    for start in range(0, X.shape[0], chunk_rows):
+        yield X[start:start + chunk_rows]
+
+
+def feature_normalize_inplace(X, mean, std, chunk_rows=10000):
+    """(X - mean) / (std + eps), computed in place in X's float32 storage
+    chunk by chunk, so no temporary copy of the matrix is made.
+    """
+    eps = np.finfo(np.float32).eps
+    mean = np.asarray(mean, dtype=np.float32)
+    scale = np.asarray(std, dtype=np.float32) + eps
+    for chunk in iter_row_chunks(X, chunk_rows):
+        chunk -= mean
+        chunk /= scale
+    return X
+
+
+def load_feature_stats(folder):
+    """Load per-gene statistics saved with a trained model. Models trained
+    before they were stored as .npy have them as pickled pandas Series.
+    """
+    if exists(join(folder, FEATURE_MEAN_FILE)):
+        return np.load(join(folder, FEATURE_MEAN_FILE)), np.load(join(folder, FEATURE_STD_FILE))
+    mean = pd.read_pickle(join(folder, "mean.p"))
+    std = pd.read_pickle(join(folder, "std.p"))
+    return mean.values, std.values
+
+
+class Normalizer(object):
+    """Holds the normalization applied to the input data, and its fitted
+    statistics. Methods are:
+        'none' - no normalization
+        'sn' - divide each sample (row) by its total
+        'gn' - standardize each gene (column) to zero mean and unit variance
+        'mn' - scale each gene (column) into feature_range
+    """
+    METHODS = ['none', 'sn', 'gn', 'mn']
+
+    def __init__(self, method='none', feature_range=(-1, 1)):
+        if method not in Normalizer.METHODS:
+            raise ScrnaException("Not a valid normalization method: {}".format(method))
+        self.method = method
+        self.feature_range = (float(feature_range[0]), float(feature_range[1]))
+        self.mean = None
+        self.std = None
+        self.data_min = None
+        self.data_max = None
+        self._moments = None
+
+    @classmethod
+    def from_args(cls, args):
+        if args.sn:
+            return cls('sn')
+        elif args.gn:
+            return cls('gn')
+        elif args.mn:
+            return cls('mn', (args.minmax_min, args.minmax_max))
+        return cls('none')
+
+    @property
+    def requires_fit(self):
+        return self.method in ('gn', 'mn')
+
+    @property
+    def is_fitted(self):
+        if self.method == 'gn':
+            return self.mean is not None
+        elif self.method == 'mn':
+            return self.data_min is not None
+        return True
+
+    def partial_fit(self, chunk):
+        """Update the statistics with one chunk of rows."""
+        if self.method == 'gn':
+            if self._moments is None:
+                self._moments = RunningMoments(chunk.shape[1])
+            self._moments.update(chunk)
+            self.mean = self._moments.mean
+            self.std = self._moments.std
+        elif self.method == 'mn':
+            chunk_min = chunk.min(axis=0).astype(np.float64)
+            chunk_max = chunk.max(axis=0).astype(np.float64)
+            if self.data_min is None:
+                self.data_min, self.data_max = chunk_min, chunk_max
+            else:
+                np.minimum(self.data_min, chunk_min, out=self.data_min)
+                np.maximum(self.data_max, chunk_max, out=self.data_max)
+        return self
+
+    def fit(self, chunks):
+        """Fit the statistics on an iterable of row chunks."""
+        self.mean = self.std = self.data_min = self.data_max = self._moments = None
+        for chunk in chunks:
+            self.partial_fit(chunk)
+        return self
+
+    def transform(self, X, chunk_rows=10000):
+        """Normalize X (dense float32 array or CSR matrix) in place, and
+        return it.
+        """
+        if self.method == 'none':
+            return X
+        if not self.is_fitted:
+            raise ScrnaException("Normalizer must be fit before it is used!")
+        eps = np.finfo(np.float32).eps
+        if sparse.issparse(X):
+            if self.method != 'sn':
+                raise ScrnaException("Only sample normalization is supported for sparse data!")
+            # Scale the stored values of each row by that row's total
+            row_sums = np.asarray(X.sum(axis=1), dtype=np.float32).ravel()
+            X.data /= np.repeat(row_sums + eps, np.diff(X.indptr))
+        elif self.method == 'sn':
+            for chunk in iter_row_chunks(X, chunk_rows):
+                chunk /= chunk.sum(axis=1, keepdims=True) + eps
+        elif self.method == 'gn':
+            feature_normalize_inplace(X, self.mean, self.std, chunk_rows)
+        elif self.method == 'mn':
+            data_range = self.data_max - self.data_min
+            data_range[data_range == 0] = 1 # same handling of constant genes as sklearn's MinMaxScaler
+            scale = ((self.feature_range[1] - self.feature_range[0]) / data_range).astype(np.float32)
+            data_min = self.data_min.astype(np.float32)
+            for chunk in iter_row_chunks(X, chunk_rows):
+                chunk -= data_min
+                chunk *= scale
+                chunk += self.feature_range[0]
+        return X
+
+    def copy_stats_from(self, other):
+        """Use the fitted statistics of another Normalizer (in place, so that
+        everything holding this Normalizer sees them).
+        """
+        for name in ['mean', 'std', 'data_min', 'data_max']:
+            setattr(self, name, getattr(other, name))
+
+    def state(self):
+        """Configuration and fitted statistics (used to identify cached data
+        normalized by this Normalizer).
+        """
+        parts = [self.method]
+        if self.method == 'mn':
+            parts.append(self.feature_range)
+        for stat in [self.mean, self.std, self.data_min, self.data_max]:
+            if stat is not None:
+                parts.append(np.asarray(stat, dtype=np.float64).tobytes())
+        return parts
+
+    def save(self, folder):
+        arrays = {'method': np.array(self.method), 'feature_range': np.array(self.feature_range)}
+        for name in ['mean', 'std', 'data_min', 'data_max']:
+            if getattr(self, name) is not None:
+                arrays[name] = np.asarray(getattr(self, name), dtype=np.float64)
+        np.savez(join(folder, NORMALIZER_FILE), **arrays)
+
+    @classmethod
+    def load(cls, folder):
+        with np.load(join(folder, NORMALIZER_FILE)) as arrays:
+            normalizer = cls(str(arrays['method']), tuple(arrays['feature_range']))
+            for name in ['mean', 'std', 'data_min', 'data_max']:
+                if name in arrays:
+                    setattr(normalizer, name, arrays[name])
+        return normalizer
+
+
+def load_normalizer(model_folder, training_args):
+    """The Normalizer that was fit when the model in model_folder was trained.
+    Older models saved their statistics in separate files.
+    """
+    if exists(join(model_folder, NORMALIZER_FILE)):
+        return Normalizer.load(model_folder)
+    normalizer = Normalizer.from_args(training_args)
+    if normalizer.method == 'gn':
+        normalizer.mean, normalizer.std = load_feature_stats(model_folder)
+    elif normalizer.method == 'mn':
+        with open(join(model_folder, 'minmax_scaler.p'), 'rb') as f:
+            minmax_scaler = pickle.load(f)
+        normalizer.data_min = minmax_scaler.data_min_
+        normalizer.data_max = minmax_scaler.data_max_
+    return normalizer
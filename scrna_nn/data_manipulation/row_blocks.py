@@ -0,0 +1,493 @@
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from glob import glob
+from os.path import isdir, join
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from . import shared
+from ..util import ScrnaException
+
+
+class ProcessLocalLock(object):
+    """A lock (threading.Lock or RLock) of which every process has its own.
+    A forked child (e.g. a Keras worker process) starts with a new, released
+    lock, even if a thread of the parent held the lock while forking.
+    """
+    def __init__(self, lock_type=threading.Lock):
+        self._lock_type = lock_type
+        self._locks = {}
+
+    def _get(self):
+        pid = os.getpid()
+        lock = self._locks.get(pid)
+        if lock is None:
+            lock = self._locks.setdefault(pid, self._lock_type())
+        return lock
+
+    def __enter__(self):
+        return self._get().__enter__()
+
+    def __exit__(self, *exc_info):
+        return self._get().__exit__(*exc_info)
+
+
+# PyTables (HDF5) is not thread-safe, even across different files, so calls
+# into it are serialized. Files are read in parallel by separate processes.
+HDF5_LOCK = ProcessLocalLock(threading.RLock)
+# RowBlockMatrix.take reads the requested rows of a block directly (rather
+# than the whole block) when they are fewer than this fraction of the block
+DIRECT_READ_FRACTION = 0.01
+
+
+def hdf_frame_shape(h5_store, key):
+    """Number of rows and columns of a DataFrame stored in an HDFStore,
+    without reading its values.
+    """
+    storer = h5_store.get_storer(key)
+    n_rows, n_cols = storer.shape
+    return int(n_rows), int(n_cols)
+
+
+def read_row_block(h5_store, key, start, stop):
+    """Read rows [start, stop) of a stored DataFrame as a float32 array,
+    with missing values filled with 0.
+    """
+    with HDF5_LOCK:
+        values = h5_store.select(key, start=start, stop=stop).values
+    block = values.astype(np.float32)
+    block[np.isnan(block)] = 0
+    return block
+
+
+def read_frame_axes(h5_store, key):
+    """The row index and the column names (as strings) of a stored DataFrame."""
+    storer = h5_store.get_storer(key)
+    return storer.read_index('axis1'), storer.read_index('axis0').astype(str)
+
+
+def read_expression_mat(filepath, key='rpkm', chunk_rows=10000, as_sparse=False, n_readers=4):
+    """Read a stored DataFrame into a float32 array (or CSR matrix, if
+    as_sparse), with missing values filled with 0. Large files are read by
+    n_readers processes, each reading a range of rows (into a shared matrix,
+    if dense). Returns the matrix along with the row index and column names.
+    """
+    with HDF5_LOCK:
+        h5_store = pd.HDFStore(filepath, mode='r')
+        n_rows, n_cols = hdf_frame_shape(h5_store, key)
+        index, columns = read_frame_axes(h5_store, key)
+        h5_store.close()
+    # At most one range of rows per chunk, small files are read here
+    n_ranges = min(n_readers, int(np.ceil(n_rows / float(chunk_rows))))
+    bounds = np.linspace(0, n_rows, n_ranges + 1).astype(np.int64)
+    if as_sparse:
+        tasks = [(filepath, key, start, stop, chunk_rows) for start, stop in zip(bounds[:-1], bounds[1:])]
+        X = _stack_sparse(_run_readers(_read_sparse_task, tasks, n_readers), n_cols)
+        print("sparse matrix density: {:.4f}".format(X.nnz / float(max(n_rows * n_cols, 1))))
+    else:
+        X = shared.create((n_rows, n_cols), np.float32)
+        tasks = [(filepath, key, shared.get_handle(X), start, start, stop, chunk_rows)
+                 for start, stop in zip(bounds[:-1], bounds[1:]) if n_cols > 0]
+        _run_readers(_fill_rows_task, tasks, n_readers)
+    return X, index, columns
+
+
+def _stack_sparse(chunks, n_cols):
+    if len(chunks) == 0:
+        return sparse.csr_matrix((0, n_cols), dtype=np.float32)
+    return sparse.vstack(chunks, format='csr')
+
+
+def _read_sparse_rows(h5_store, key, n_rows, chunk_rows, first_row=0):
+    chunks = []
+    for start in range(first_row, first_row + n_rows, chunk_rows):
+        stop = min(start + chunk_rows, first_row + n_rows)
+        chunks.append(sparse.csr_matrix(read_row_block(h5_store, key, start, stop)))
+    if len(chunks) == 0:
+        with HDF5_LOCK:
+            n_cols = hdf_frame_shape(h5_store, key)[1]
+        return sparse.csr_matrix((0, n_cols), dtype=np.float32)
+    return sparse.vstack(chunks, format='csr')
+
+
+def _fill_rows(h5_store, key, out, chunk_rows, first_row=0):
+    # Copy rows of a stored DataFrame, starting at first_row, into out (a
+    # float32 array)
+    for start in range(0, out.shape[0], chunk_rows):
+        stop = min(start + chunk_rows, out.shape[0])
+        chunk = out[start:stop]
+        with HDF5_LOCK:
+            values = h5_store.select(key, start=first_row + start, stop=first_row + stop).values
+        chunk[...] = values
+        chunk[np.isnan(chunk)] = 0
+
+
+def _fill_rows_task(filepath, key, handle, offset, start, stop, chunk_rows):
+    # Copy rows [start, stop) of a stored DataFrame into the shared matrix
+    # of handle, starting at row offset
+    out = shared.attach(handle, mode='r+')
+    with HDF5_LOCK:
+        h5_store = pd.HDFStore(filepath, mode='r')
+    _fill_rows(h5_store, key, out[offset:offset + stop - start], chunk_rows, start)
+    with HDF5_LOCK:
+        h5_store.close()
+    out.flush()
+
+
+def _read_sparse_task(filepath, key, start, stop, chunk_rows):
+    with HDF5_LOCK:
+        h5_store = pd.HDFStore(filepath, mode='r')
+    X = _read_sparse_rows(h5_store, key, stop - start, chunk_rows, start)
+    with HDF5_LOCK:
+        h5_store.close()
+    return X
+
+
+def _run_readers(fcn, tasks, n_readers):
+    # PyTables cannot read files concurrently within a process, so read
+    # tasks are run by a pool of n_readers new (spawned) processes, which
+    # do not inherit open files or a held HDF5_LOCK. Runs them here if
+    # n_readers <= 1 (or there is a single CPU).
+    n_readers = min(n_readers, multiprocessing.cpu_count())
+    if n_readers <= 1 or len(tasks) <= 1:
+        return [fcn(*task) for task in tasks]
+    with multiprocessing.get_context('spawn').Pool(min(n_readers, len(tasks))) as pool:
+        return pool.starmap(fcn, tasks)
+
+
+def list_shards(path):
+    """The HDF5 shards (e.g. one per study) of a sharded split directory, in
+    a fixed (sorted) order.
+    """
+    shard_paths = sorted(glob(join(path, '*.h5')))
+    if len(shard_paths) == 0:
+        raise ScrnaException("No .h5 shards found in {}".format(path))
+    return shard_paths
+
+
+def is_sharded(path):
+    return isdir(path)
+
+
+def read_matrix_shape(filepath, key='rpkm'):
+    """Shape of the expression matrix of a split (a single HDF5 file or a
+    directory of shards), without reading it.
+    """
+    shard_paths = list_shards(filepath) if is_sharded(filepath) else [filepath]
+    n_rows, n_cols = 0, 0
+    for shard_path in shard_paths:
+        with HDF5_LOCK:
+            h5_store = pd.HDFStore(shard_path, mode='r')
+            shard_rows, n_cols = hdf_frame_shape(h5_store, key)
+            h5_store.close()
+        n_rows += shard_rows
+    return n_rows, n_cols
+
+
+def _read_shard_axes(shard_paths, key):
+    # Shapes and axes of every shard, checking that all shards have the same
+    # genes (columns) in the same order
+    shapes, indexes = [], []
+    columns = None
+    for shard_path in shard_paths:
+        with HDF5_LOCK:
+            h5_store = pd.HDFStore(shard_path, mode='r')
+            shapes.append(hdf_frame_shape(h5_store, key))
+            index, shard_columns = read_frame_axes(h5_store, key)
+            h5_store.close()
+        if columns is None:
+            columns = shard_columns
+        elif not columns.equals(shard_columns):
+            raise ScrnaException("Shard {} does not have the same genes as {}!".format(shard_path, shard_paths[0]))
+        indexes.append(index)
+    return shapes, indexes[0].append(indexes[1:]), columns
+
+
+def read_sharded_expression_mat(shard_paths, key='rpkm', chunk_rows=10000, as_sparse=False, n_readers=4):
+    """Same as read_expression_mat, for a split stored as many HDF5 shards
+    (read in parallel by n_readers processes, into a shared matrix).
+    """
+    shapes, index, columns = _read_shard_axes(shard_paths, key)
+    offsets = np.cumsum([0] + [shape[0] for shape in shapes])
+    n_rows, n_cols = int(offsets[-1]), shapes[0][1]
+    if as_sparse:
+        tasks = [(shard_path, key, 0, shape[0], chunk_rows) for shard_path, shape in zip(shard_paths, shapes)]
+        X = sparse.vstack(_run_readers(_read_sparse_task, tasks, n_readers), format='csr')
+        print("sparse matrix density: {:.4f}".format(X.nnz / float(max(n_rows * n_cols, 1))))
+    else:
+        X = shared.create((n_rows, n_cols), np.float32)
+        tasks = [(shard_path, key, shared.get_handle(X), offsets[i], 0, shapes[i][0], chunk_rows)
+                 for i, shard_path in enumerate(shard_paths) if shapes[i][0] * n_cols > 0]
+        _run_readers(_fill_rows_task, tasks, n_readers)
+    return X, index, columns
+
+
+class RowBlockMatrix(object):
+    """A read-only view of the expression matrix stored in an HDF5 file,
+    read lazily in blocks of block_size rows (at most max_cached_blocks are
+    kept in memory). Supports ndarray-style row indexing.
+    """
+    def __init__(self, filepath, key='rpkm', block_size=10000, max_cached_blocks=2, transform=None):
+        self.filepath = filepath
+        self.key = key
+        self.block_size = block_size
+        self.max_cached_blocks = max_cached_blocks
+        # Applied to each block (in place) right after it is read from disk,
+        # e.g. normalization
+        self.transform = transform
+        with HDF5_LOCK:
+            h5_store = pd.HDFStore(filepath, mode='r')
+            self.shape = hdf_frame_shape(h5_store, key)
+            self.index, self.columns = read_frame_axes(h5_store, key)
+            h5_store.close()
+        self.ndim = 2
+        self.dtype = np.dtype(np.float32)
+        self.n_blocks = int(np.ceil(self.shape[0] / float(self.block_size)))
+        self._store = None
+        self._store_pid = None
+        self._cache = OrderedDict()
+        self._lock = ProcessLocalLock()
+
+    def __getstate__(self):
+        # Open file handles and cached blocks are not shared with other processes
+        state = self.__dict__.copy()
+        state['_store'] = None
+        state['_cache'] = OrderedDict()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = ProcessLocalLock()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def block_bounds(self, block_idx):
+        start = block_idx * self.block_size
+        return start, min(start + self.block_size, self.shape[0])
+
+    def _open_store(self):
+        # A forked child opens the file again rather than sharing the
+        # parent's HDF5 handle
+        if self._store is None or self._store_pid != os.getpid():
+            with HDF5_LOCK:
+                self._store = pd.HDFStore(self.filepath, mode='r')
+            self._store_pid = os.getpid()
+        return self._store
+
+    def _read_block(self, block_idx):
+        start, stop = self.block_bounds(block_idx)
+        block = read_row_block(self._open_store(), self.key, start, stop)
+        if self.transform is not None:
+            block = self.transform(block)
+        return block
+
+    def get_block(self, block_idx):
+        with self._lock:
+            if block_idx in self._cache:
+                self._cache.move_to_end(block_idx)
+                return self._cache[block_idx]
+            block = self._read_block(block_idx)
+            self._cache[block_idx] = block
+            while len(self._cache) > self.max_cached_blocks:
+                self._cache.popitem(last=False)
+            return block
+
+    def iter_blocks(self, raw=False):
+        """Yield every block of rows in order. With raw=True, blocks are
+        read without applying the transform and are not cached (used to
+        compute normalization statistics).
+        """
+        for block_idx in range(self.n_blocks):
+            if raw:
+                start, stop = self.block_bounds(block_idx)
+                with self._lock:
+                    block = read_row_block(self._open_store(), self.key, start, stop)
+                yield block
+            else:
+                yield self.get_block(block_idx)
+
+    def _read_rows(self, rows):
+        # Read and transform the given (sorted, unique) rows only, one run of
+        # consecutive rows at a time
+        runs = np.split(rows, np.where(np.diff(rows) != 1)[0] + 1)
+        with self._lock:
+            store = self._open_store()
+            values = np.concatenate([read_row_block(store, self.key, run[0], run[-1] + 1) for run in runs])
+        if self.transform is not None:
+            values = self.transform(values)
+        return values
+
+    def take(self, rows):
+        """Gather the given rows into a new float32 array. Blocks that are
+        cached or that many rows are taken from are read (once) and cached,
+        the rows scattered over other blocks are read directly.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        rows[rows < 0] += self.shape[0]
+        out = np.empty((rows.shape[0], self.shape[1]), dtype=np.float32)
+        block_ids = rows // self.block_size
+        direct = np.zeros(len(rows), dtype=bool)
+        for block_idx in np.unique(block_ids):
+            positions = np.where(block_ids == block_idx)[0]
+            if block_idx not in self._cache and len(positions) < self.block_size * DIRECT_READ_FRACTION:
+                direct[positions] = True
+                continue
+            start, _ = self.block_bounds(block_idx)
+            out[positions] = self.get_block(block_idx)[rows[positions] - start]
+        if direct.any():
+            direct_rows, inverse = np.unique(rows[direct], return_inverse=True)
+            out[direct] = self._read_rows(direct_rows)[inverse]
+        return out
+
+    def __getitem__(self, item):
+        if isinstance(item, tuple):
+            rows = self[item[0]]
+            return rows[(slice(None),) + item[1:]]
+        if isinstance(item, (int, np.integer)):
+            return self.take([item])[0]
+        if isinstance(item, slice):
+            return self.take(np.arange(*item.indices(self.shape[0])))
+        return self.take(item)
+
+    def to_array(self):
+        """Materialize the whole (transformed) matrix in memory."""
+        out = np.empty(self.shape, dtype=np.float32)
+        for block_idx in range(self.n_blocks):
+            start, stop = self.block_bounds(block_idx)
+            with self._lock:
+                out[start:stop] = self._read_block(block_idx)
+        return out
+
+    def block_shuffled_indices(self):
+        """A permutation of the row indices that visits the blocks, and the
+        rows within each block, in a random order.
+        """
+        index_arrays = []
+        for block_idx in np.random.permutation(self.n_blocks):
+            start, stop = self.block_bounds(block_idx)
+            index_arrays.append(start + np.random.permutation(stop - start))
+        return np.concatenate(index_arrays)
+
+    def close(self):
+        with self._lock:
+            # The parent process closes the handle it opened
+            if self._store is not None and self._store_pid == os.getpid():
+                with HDF5_LOCK:
+                    self._store.close()
+            self._store = None
+            self._cache.clear()
+
+
+class ShardedRowMatrix(RowBlockMatrix):
+    """A RowBlockMatrix over a split stored as many HDF5 shards, with rows
+    numbered globally in shard order.
+    """
+    def __init__(self, shard_paths, key='rpkm', block_size=10000, max_cached_blocks=2, transform=None):
+        self.shard_paths = list(shard_paths)
+        self.key = key
+        self.block_size = block_size
+        self.max_cached_blocks = max_cached_blocks
+        shapes, self.index, self.columns = _read_shard_axes(self.shard_paths, key)
+        self.shards = [RowBlockMatrix(path, key, block_size, max_cached_blocks) for path in self.shard_paths]
+        self.offsets = np.cumsum([0] + [shape[0] for shape in shapes])
+        self.shape = (int(self.offsets[-1]), shapes[0][1])
+        self.ndim = 2
+        self.dtype = np.dtype(np.float32)
+        # (shard, block within the shard) of each global block
+        self._block_ids = [(i, b) for i, shard in enumerate(self.shards) for b in range(shard.n_blocks)]
+        self.n_blocks = len(self._block_ids)
+        self.transform = transform
+        self._lock = ProcessLocalLock()
+
+    @property
+    def transform(self):
+        return self.shards[0].transform
+
+    @transform.setter
+    def transform(self, transform):
+        for shard in self.shards:
+            shard.transform = transform
+
+    def block_bounds(self, block_idx):
+        shard_idx, shard_block_idx = self._block_ids[block_idx]
+        start, stop = self.shards[shard_idx].block_bounds(shard_block_idx)
+        return self.offsets[shard_idx] + start, self.offsets[shard_idx] + stop
+
+    def _read_block(self, block_idx):
+        shard_idx, shard_block_idx = self._block_ids[block_idx]
+        return self.shards[shard_idx]._read_block(shard_block_idx)
+
+    def get_block(self, block_idx):
+        shard_idx, shard_block_idx = self._block_ids[block_idx]
+        return self.shards[shard_idx].get_block(shard_block_idx)
+
+    def iter_blocks(self, raw=False):
+        for shard in self.shards:
+            for block in shard.iter_blocks(raw):
+                yield block
+
+    def take(self, rows):
+        # The shards are read one after another (PyTables reads serially
+        # within a process). Sequence worker processes (use_multiprocessing)
+        # each read the shards with their own files.
+        rows = np.asarray(rows, dtype=np.int64)
+        rows[rows < 0] += self.shape[0]
+        out = np.empty((rows.shape[0], self.shape[1]), dtype=np.float32)
+        shard_ids = np.searchsorted(self.offsets, rows, side='right') - 1
+        for shard_idx in np.unique(shard_ids):
+            positions = np.where(shard_ids == shard_idx)[0]
+            out[positions] = self.shards[shard_idx].take(rows[positions] - self.offsets[shard_idx])
+        return out
+
+    def to_array(self):
+        out = np.empty(self.shape, dtype=np.float32)
+        for shard_idx, shard in enumerate(self.shards):
+            out[self.offsets[shard_idx]:self.offsets[shard_idx + 1]] = shard.to_array()
+        return out
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+
+def take_rows(X, rows):
+    """Gather rows of any supported expression matrix (ndarray, memmap,
+    RowBlockMatrix or scipy sparse matrix) as a dense float32 array. Sparse
+    matrices are only densified for the requested rows.
+    """
+    batch = X[rows]
+    if sparse.issparse(batch):
+        batch = batch.toarray()
+    return batch
+
+
+def iter_row_blocks(X, block_size=10000):
+    """Yield dense blocks of rows of X, in order."""
+    if isinstance(X, RowBlockMatrix):
+        for block in X.iter_blocks():
+            yield block
+    else:
+        for start in range(0, X.shape[0], block_size):
+            yield take_rows(X, slice(start, start + block_size))
+
+
+def requires_blocks(X):
+    """Whether X must be processed block by block (it is out-of-core, or it
+    is sparse and must be densified first).
+    """
+    return isinstance(X, RowBlockMatrix) or sparse.issparse(X)
+
+
+def transform_in_blocks(transform_fcn, X):
+    """Apply transform_fcn (e.g. a model's predict) to X. Out-of-core and
+    sparse matrices are transformed one (dense) block of rows at a time.
+    """
+    if requires_blocks(X):
+        return np.concatenate([transform_fcn(block) for block in iter_row_blocks(X)])
+    return transform_fcn(X)
@@ -0,0 +1,77 @@
+import mmap
+import os
+import tempfile
+import weakref
+from collections import namedtuple
+
+import numpy as np
+
+# Shared matrices are kept in files here (RAM-backed) when there is room,
+# otherwise in the default temporary directory
+SHARED_DIRS = ['/dev/shm']
+
+# A small, picklable description of a shared matrix. Passing it to a worker
+# process (instead of the matrix itself) lets the worker map the same file
+# without copying it
+SharedHandle = namedtuple('SharedHandle', ['filename', 'shape', 'dtype', 'offset'])
+
+
+def _shared_dir(n_bytes):
+    for folder in SHARED_DIRS:
+        if os.path.isdir(folder):
+            stats = os.statvfs(folder)
+            if stats.f_bavail * stats.f_frsize > n_bytes:
+                return folder
+    return tempfile.gettempdir()
+
+
+def _remove(filename, owner_pid):
+    # Forked children inherit the finalizer, only the creating process
+    # removes the file
+    if os.getpid() == owner_pid:
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+
+def create(shape, dtype=np.float32):
+    """A new matrix in a memory-mapped temporary file, which worker processes
+    attach to by its handle. The file is removed once the matrix (and every
+    view of it) is freed in this process.
+    """
+    dtype = np.dtype(dtype)
+    shape = tuple(int(n) for n in shape)
+    n_bytes = int(np.prod(shape)) * dtype.itemsize
+    if n_bytes == 0:
+        # Empty files cannot be memory-mapped
+        return np.zeros(shape, dtype=dtype)
+    fd, filename = tempfile.mkstemp(prefix='scrna_nn_', suffix='.dat', dir=_shared_dir(n_bytes))
+    os.close(fd)
+    X = np.memmap(filename, dtype=dtype, mode='w+', shape=shape)
+    weakref.finalize(X, _remove, filename, os.getpid())
+    return X
+
+
+def from_array(X, dtype=None):
+    """Copy X into a new shared matrix (of the same dtype, by default)."""
+    shared_X = create(X.shape, X.dtype if dtype is None else dtype)
+    shared_X[...] = X
+    return shared_X
+
+
+def get_handle(X):
+    """The handle of X if worker processes can attach to it (it is a shared
+    matrix, or any other C-ordered memory-mapped file, e.g. a cached split),
+    otherwise None.
+    """
+    if isinstance(X, np.memmap) and isinstance(X.base, mmap.mmap) and X.flags.c_contiguous:
+        return SharedHandle(X.filename, X.shape, X.dtype.str, X.offset)
+    return None
+
+
+def attach(handle, mode='r'):
+    """Map a shared matrix from a worker process (read-only, unless
+    mode='r+').
+    """
+    return np.memmap(handle.filename, dtype=handle.dtype, mode=mode, offset=handle.offset, shape=handle.shape)
@@ -1,145 +1,312 @@
-import random
-from itertools import combinations
+import multiprocessing
+from itertools import chain, combinations, islice
 
 import numpy as np
+from sklearn.neighbors import NearestNeighbors
 
-from .. import util
-from ..util import ScrnaException, distances
+from ..util import ScrnaException, cache, distances
 
 CACHE_ROOT = "_cache"
 SIAM_CACHE = "siam_data"
+# Give up redrawing anchors for different-pairs after this many rounds
+MAX_ANCHOR_REDRAWS = 1000
 
-def get_bucket_boundaries(sorted_tuple_list, n_buckets):
-    step_size = (sorted_tuple_list[-1][0] - sorted_tuple_list[0][0]) / n_buckets
-    boundaries = []
-    left_idx = 0
-    right_idx = 0
-    for i in range(n_buckets-1):
-        while right_idx < len(sorted_tuple_list) and sorted_tuple_list[right_idx][0] < sorted_tuple_list[0][0] + ((i+1)*step_size):
-            right_idx += 1
-        boundaries.append((left_idx, right_idx))
-        left_idx = right_idx
-    boundaries.append((left_idx, len(sorted_tuple_list)))
-    return boundaries
-
-def uniformly_select_diff_pairs(n_buckets, candidate_diff_samples, X, y, true_ids, anchor_samples, same_count, diff_pairs_multiplier):
-    pairs = []
-    labels = []
-    sorted_candidates = sorted(candidate_diff_samples, key=lambda tup: tup[0])
-    bucket_boundaries = get_bucket_boundaries(sorted_candidates, n_buckets)
-    for boundaries in bucket_boundaries:
-        subset = sorted_candidates[boundaries[0]:boundaries[1]]
-        random.shuffle(subset)
-        num_to_take = min(len(subset), int(diff_pairs_multiplier*same_count/n_buckets))
-        for i in range(num_to_take):
-            # select a random anchor sample
-            anchor_idx = random.choice(anchor_samples)
-            diff_idx = subset[i][2]
-            similarity = subset[i][1] # use the transformed similarity
-            while(true_ids[anchor_idx] == true_ids[diff_idx]):
-                # for the current different sample, be sure they aren't the same underlying sample
-                anchor_idx = random.choice(anchor_samples)
-            anchor_vec = X[anchor_idx]
-            diff_vec = X[diff_idx]
-            pairs += [[ anchor_vec, diff_vec ]]
-            labels += [similarity]
-    return pairs, labels
+def get_bucket_ids(similarities, n_buckets):
+    """Assign each similarity to one of n_buckets equal-width buckets between
+    the smallest and the largest similarity.
+    """
+    lowest = similarities.min()
+    step_size = (similarities.max() - lowest) / n_buckets
+    bucket_edges = lowest + step_size * np.arange(1, n_buckets)
+    return np.digitize(similarities, bucket_edges)
 
-def unconstrained_select_diff_pairs(candidate_diff_samples, X, y, true_ids, anchor_samples, same_count, diff_pairs_multiplier):
-    pairs = []
-    labels = []
-    random.shuffle(candidate_diff_samples)
-    num_to_take = min(len(candidate_diff_samples), diff_pairs_multiplier*same_count)
-    for i in range(num_to_take):
-        # select a random anchor sample
-        anchor_idx = random.choice(anchor_samples)
-        diff_idx = candidate_diff_samples[i][2]
-        similarity = candidate_diff_samples[i][1] # use the transformed similarity
-        while(true_ids[anchor_idx] == true_ids[diff_idx]):
-            # for the current different sample, be sure they aren't the same underlying sample
-            anchor_idx = random.choice(anchor_samples)
-        anchor_vec = X[anchor_idx]
-        diff_vec = X[diff_idx]
-        pairs += [[ anchor_vec, diff_vec ]]
-        labels += [similarity]
-    return pairs, labels
+def select_anchors(diff_samples, anchor_samples, true_ids, rng=np.random):
+    """Select a random anchor sample for each different sample, redrawing the
+    anchors that are the same underlying sample (true id) as their different
+    sample.
+    """
+    anchors = rng.choice(anchor_samples, len(diff_samples))
+    redraw = np.where(true_ids[anchors] == true_ids[diff_samples])[0]
+    n_redraws = 0
+    while len(redraw) > 0:
+        n_redraws += 1
+        if n_redraws > MAX_ANCHOR_REDRAWS:
+            raise ScrnaException("Could not find anchors that are different samples from their pairs!")
+        anchors[redraw] = rng.choice(anchor_samples, len(redraw))
+        redraw = redraw[true_ids[anchors[redraw]] == true_ids[diff_samples[redraw]]]
+    return anchors
+
+def make_diff_pairs(diff_samples, anchor_samples, true_ids, similarities, rng=np.random):
+    anchors = select_anchors(diff_samples, anchor_samples, true_ids, rng)
+    return np.stack([anchors, diff_samples], axis=1).astype(np.int32), similarities.astype(np.float32)
+
+def uniformly_select_diff_pairs(n_buckets, candidates, raw_similarities, transformed_similarities, true_ids, anchor_samples, same_count, diff_pairs_multiplier, rng=np.random):
+    # Take the same number of different samples from each bucket of (raw)
+    # similarity to the anchor label
+    bucket_ids = get_bucket_ids(raw_similarities, n_buckets)
+    num_per_bucket = int(diff_pairs_multiplier*same_count/n_buckets)
+    selected = []
+    for bucket in range(n_buckets):
+        in_bucket = np.where(bucket_ids == bucket)[0]
+        num_to_take = min(len(in_bucket), num_per_bucket)
+        selected.append(rng.choice(in_bucket, num_to_take, replace=False))
+    selected = np.concatenate(selected)
+    return make_diff_pairs(candidates[selected], anchor_samples, true_ids, transformed_similarities[selected], rng)
 
-def select_diff_pairs(X, y, true_ids, label_strings_lookup, anchor_label, anchor_samples, indices_lists, similarity_fcn, same_count, args):
-    similarity_to_anchor = [] # elements will be tuples of (raw_similarity, transformed_similarity, diff_sample_id) where similarity is the similarity b/w this diff sample and the anchor sample
-    for diff_label, diff_samples in indices_lists.items():
-        if diff_label == anchor_label:
-            continue # picked a cell type that is same as anchor type, we want one that is different
-        anchor_string = label_strings_lookup[anchor_label]
-        diff_string = label_strings_lookup[diff_label]
-        raw_similarity = similarity_fcn(anchor_string, diff_string, transform=False)
-        transformed_similarity = similarity_fcn(anchor_string, diff_string, transform=True)
-        for s in diff_samples:
-            similarity_to_anchor.append((raw_similarity, transformed_similarity, s))
+def unconstrained_select_diff_pairs(candidates, transformed_similarities, true_ids, anchor_samples, same_count, diff_pairs_multiplier, rng=np.random):
+    num_to_take = min(len(candidates), int(diff_pairs_multiplier*same_count))
+    selected = rng.choice(len(candidates), num_to_take, replace=False)
+    return make_diff_pairs(candidates[selected], anchor_samples, true_ids, transformed_similarities[selected], rng)
+
+def select_diff_pairs(y, true_ids, anchor_label, anchor_samples, similarity, same_count, args, rng=np.random):
+    # Every sample with a different label is a candidate, and its similarity
+    # to the anchor is the similarity between the two labels
+    candidates = np.where(y != anchor_label)[0]
+    raw_similarities = similarity.raw[anchor_label, y[candidates]]
+    transformed_similarities = similarity.transformed[anchor_label, y[candidates]]
+    if len(candidates) == 0:
+        return np.empty((0, 2), dtype=np.int32), np.empty(0, dtype=np.float32)
     if args.unif_diff > 0:
-        print("uniform!")
-        pairs, labels = uniformly_select_diff_pairs(args.unif_diff, similarity_to_anchor, X, y, true_ids, anchor_samples, same_count, args.diff_multiplier)
+        return uniformly_select_diff_pairs(args.unif_diff, candidates, raw_similarities, transformed_similarities, true_ids, anchor_samples, same_count, args.diff_multiplier, rng)
     else:
-        print("unconstrained!")
-        pairs, labels = unconstrained_select_diff_pairs(similarity_to_anchor, X, y, true_ids, anchor_samples, same_count, args.diff_multiplier)
-    return pairs, labels
+        return unconstrained_select_diff_pairs(candidates, transformed_similarities, true_ids, anchor_samples, same_count, args.diff_multiplier, rng)
 
-#def create_flexible_data_pairs(X, y, true_ids, indices_lists, same_lim, label_strings_lookup, args):
-def create_flexible_data_pairs(X, y, true_ids, label_strings_lookup, args):
-    # normalization = ""
-    # if args['--sn']:
-    #     normalization = "sn"
-    # elif args['--gn']:
-    #     normalization = "gn"
-    # config_string = '_'.join([args['--data'], normalization, args['--dynMarginLoss'], args['--dist_mat_file'], args['--trnsfm_fcn'], args['--trnsfm_fcn_param'], args['--unif_diff'], args['--same_lim'], args['--diff_multiplier']])
-    # cache_path = join(join(CACHE_ROOT, SIAM_CACHE), config_string)
-    # if exists(cache_path):
-    #     print("Loading siamese data from cache...")
-    #     pairs = np.load(join(cache_path, "siam_X.npy"))
-    #     labels = np.load(join(cache_path, "siam_y.npy"))
-    #     return pairs, labels
-    same_lim = args.same_lim
+def select_same_pairs(anchor_samples, same_lim):
+    # The first same_lim combinations of samples with the anchor label
+    combs = islice(combinations(anchor_samples, 2), same_lim)
+    return np.fromiter(chain.from_iterable(combs), dtype=np.int32).reshape(-1, 2)
+
+def get_similarity_fcn(args):
     if args.dynMarginLoss == 'ontology':
         print("ontology-based similarities")
-        similarity_fcn = distances.OntologyBasedPairSimilarity(max_ontology_distance=args.max_ont_dist,
-                                                               distance_mat_file=args.dist_mat_file,
-                                                               transform=args.trnsfm_fcn,
-                                                               transform_param=args.trnsfm_fcn_param)
+        return distances.OntologyBasedPairSimilarity(max_ontology_distance=args.max_ont_dist,
+                                                     distance_mat_file=args.dist_mat_file,
+                                                     transform=args.trnsfm_fcn,
+                                                     transform_param=args.trnsfm_fcn_param)
     elif args.dynMarginLoss == 'text-mined':
         print("text-mined similarities")
-        similarity_fcn = distances.TextMinedPairSimilarity(distance_mat_file=args.dist_mat_file,
-                                                           transform=args.trnsfm_fcn,
-                                                           transform_param=args.trnsfm_fcn_param)
+        return distances.TextMinedPairSimilarity(distance_mat_file=args.dist_mat_file,
+                                                 transform=args.trnsfm_fcn,
+                                                 transform_param=args.trnsfm_fcn_param)
     else:
         raise ScrnaException("Not a valid dynMarginLoss type!")
 
-    print("Generating 'Flexible' pairs for siamese")
-    pairs = []
-    labels = []
-    indices_lists = util.build_indices_master_list(X, y)
-
-    for anchor_label, anchor_samples in indices_lists.items():
-        same_count = 0
-        combs = combinations(anchor_samples, 2)
-        # TODO: should I shuffle the combs?
-        for comb in combs:
-            pairs += [[ X[comb[0]], X[comb[1]] ]]
-            labels += [1]
-            same_count += 1
-            if same_count == same_lim:
-                break
-        # create the different pairs
-        diff_pairs, diff_labels = select_diff_pairs(X, y, true_ids, label_strings_lookup, anchor_label, anchor_samples, indices_lists, similarity_fcn, same_count, args)
-        pairs += diff_pairs
-        labels += diff_labels
-
-    print("Generated ", len(pairs), " pairs")
-    unique_labels, label_counts = np.unique(labels, return_counts=True)
+def compile_similarity(label_strings_lookup, args):
+    # Labels are encoded as their index in label_strings_lookup. The compiled
+    # matrix is kept in the siamese cache, and memory-mapped from there.
+    similarity = get_similarity_fcn(args).compile_cached(label_strings_lookup, cache.get_siamese_cache(args))
+    if np.isnan(similarity.raw).any():
+        raise ScrnaException("Similarity is not available for every pair of labels!")
+    return similarity
+
+def create_label_pairs(anchor_label, y, true_ids, similarity, args, rng=np.random):
+    """The same-pairs and different-pairs of one anchor label."""
+    anchor_samples = np.where(y == anchor_label)[0]
+    same_pairs = select_same_pairs(anchor_samples, args.same_lim)
+    diff_pairs, diff_labels = select_diff_pairs(y, true_ids, anchor_label, anchor_samples, similarity, len(same_pairs), args, rng)
+    pairs = np.concatenate([same_pairs, diff_pairs])
+    labels = np.concatenate([np.ones(len(same_pairs), dtype=np.float32), diff_labels])
+    return pairs, labels
+
+# Inputs of create_label_pairs in pair generation worker processes, set once
+# per worker by _init_pair_worker rather than sent with every label
+_pair_worker_data = None
+
+def _init_pair_worker(y, true_ids, similarity, args):
+    global _pair_worker_data
+    _pair_worker_data = (y, true_ids, similarity, args)
+
+def _create_label_pairs_worker(anchor_label, seed):
+    y, true_ids, similarity, args = _pair_worker_data
+    return create_label_pairs(anchor_label, y, true_ids, similarity, args, np.random.RandomState(seed))
+
+def create_flexible_data_pairs(X, y, true_ids, label_strings_lookup, args, n_workers=1):
+    """Select pairs of samples for training a siamese network, as an
+    (n_pairs, 2) int32 array of row indices into X and the similarity of each
+    pair. Labels are processed by n_workers processes.
+    """
+    similarity = compile_similarity(label_strings_lookup, args)
+    y = np.asarray(y)
+    true_ids = np.asarray(true_ids)
+    anchor_labels = np.unique(y)
+    seeds = np.random.randint(2**31 - 1, size=len(anchor_labels))
+    n_workers = max(1, min(n_workers, len(anchor_labels)))
+    print("Generating 'Flexible' pairs for siamese ({} samples, {}, {} workers)".format(X.shape[0], "uniform" if args.unif_diff > 0 else "unconstrained", n_workers))
+    if n_workers > 1:
+        with multiprocessing.Pool(processes=n_workers, initializer=_init_pair_worker, initargs=(y, true_ids, similarity, args)) as pool:
+            results = pool.starmap(_create_label_pairs_worker, zip(anchor_labels, seeds))
+    else:
+        results = [create_label_pairs(anchor_label, y, true_ids, similarity, args, np.random.RandomState(seed))
+                   for anchor_label, seed in zip(anchor_labels, seeds)]
+    pairs_np = np.concatenate([pairs for pairs, _ in results])
+    labels_np = np.concatenate([labels for _, labels in results])
+
+    print("Generated ", len(pairs_np), " pairs")
+    unique_labels, label_counts = np.unique(labels_np, return_counts=True)
     print("Distribution of pairs labels: ")
     print(unique_labels)
     print(label_counts)
-    pairs_np = np.array(pairs)
-    labels_np = np.array(labels)
-    # makedirs(cache_path)
-    # np.save(join(cache_path, "siam_X"), pairs_np)
-    # np.save(join(cache_path, "siam_y"), labels_np)
     return pairs_np, labels_np
+
+class PairSampler(object):
+    """Draws a fresh set of siamese pairs every epoch, with the same
+    composition as the pairs of create_flexible_data_pairs.
+    """
+    def __init__(self, y, true_ids, similarity, args):
+        self.y = np.asarray(y)
+        self.true_ids = np.asarray(true_ids)
+        self.transformed = similarity.transformed
+        n_labels = similarity.raw.shape[0]
+        n_samples = len(self.y)
+        n_buckets = max(args.unif_diff, 1)
+        counts = np.bincount(self.y, minlength=n_labels)
+        self.counts = counts
+        self.order = np.argsort(self.y, kind='stable').astype(np.int32)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        # Row a holds the other labels sorted by their bucket of similarity
+        # to a, and where their samples start/end when counted in that order.
+        # Rows are shifted by a * n_samples so that one searchsorted over the
+        # flattened arrays finds the label of a draw for any anchor label
+        self.diff_labels = np.zeros((n_labels, n_labels), dtype=np.int32)
+        self.diff_starts = np.repeat(np.arange(n_labels, dtype=np.int64) * n_samples, n_labels).reshape(n_labels, n_labels)
+        self.diff_ends = self.diff_starts.copy()
+        self.bucket_bounds = np.zeros((n_labels, n_buckets + 1), dtype=np.int64)
+        slot_labels = []
+        slot_buckets = []
+        for anchor_label in np.where(counts > 0)[0]:
+            others = np.where((counts > 0) & (np.arange(n_labels) != anchor_label))[0]
+            n_same = min(counts[anchor_label] * (counts[anchor_label] - 1) // 2, args.same_lim)
+            shift = anchor_label * n_samples
+            bucket_ids = np.zeros(len(others), dtype=np.int64)
+            if len(others) > 0 and args.unif_diff > 0:
+                bucket_ids = get_bucket_ids(similarity.raw[anchor_label, others], n_buckets)
+            sort = np.argsort(bucket_ids, kind='stable')
+            others, bucket_ids = others[sort], bucket_ids[sort]
+            # Labels without samples (including the anchor label) are zero-width
+            # and never found by searchsorted
+            row_labels = np.concatenate([others, np.setdiff1d(np.arange(n_labels), others)])
+            self.diff_labels[anchor_label] = row_labels
+            widths = counts[row_labels] * np.isin(row_labels, others)
+            self.diff_ends[anchor_label] = shift + np.cumsum(widths)
+            self.diff_starts[anchor_label] = self.diff_ends[anchor_label] - widths
+            bucket_sizes = np.bincount(bucket_ids, weights=counts[others], minlength=n_buckets).astype(np.int64)
+            self.bucket_bounds[anchor_label] = shift + np.concatenate([[0], np.cumsum(bucket_sizes)])
+            slot_labels.append(np.full(n_same, anchor_label))
+            slot_buckets.append(np.full(n_same, -1))
+            for bucket in range(n_buckets):
+                n_diff = min(bucket_sizes[bucket], int(args.diff_multiplier*n_same/n_buckets))
+                slot_labels.append(np.full(n_diff, anchor_label))
+                slot_buckets.append(np.full(n_diff, bucket))
+        self.diff_labels = self.diff_labels.ravel()
+        self.diff_starts = self.diff_starts.ravel()
+        self.diff_ends = self.diff_ends.ravel()
+        # A slot is one pair of an epoch: its anchor label and bucket (-1 for
+        # a same-pair)
+        self.slot_labels = np.concatenate(slot_labels).astype(np.int32)
+        self.slot_buckets = np.concatenate(slot_buckets).astype(np.int32)
+        self.slot_order = np.arange(len(self.slot_labels))
+        print("Resampling {} pairs ({} same) every epoch".format(len(self), np.sum(self.slot_buckets == -1)))
+
+    def __len__(self):
+        return len(self.slot_labels)
+
+    def shuffle(self, rng=np.random):
+        self.slot_order = rng.permutation(len(self.slot_labels))
+
+    def _draw_from_labels(self, labels, rng):
+        return self.order[self.offsets[labels] + (rng.random_sample(len(labels)) * self.counts[labels]).astype(np.int64)]
+
+    def draw(self, slots, rng=np.random):
+        """Draw the pairs (row indices, similarities) for a range or array of
+        slots of the current (shuffled) epoch.
+        """
+        slots = self.slot_order[slots]
+        labels = self.slot_labels[slots]
+        buckets = self.slot_buckets[slots]
+        pairs = np.empty((len(slots), 2), dtype=np.int32)
+        sims = np.ones(len(slots), dtype=np.float32)
+
+        same = np.where(buckets == -1)[0]
+        same_labels = labels[same]
+        first = (rng.random_sample(len(same)) * self.counts[same_labels]).astype(np.int64)
+        second = (rng.random_sample(len(same)) * (self.counts[same_labels] - 1)).astype(np.int64)
+        second += second >= first
+        pairs[same, 0] = self.order[self.offsets[same_labels] + first]
+        pairs[same, 1] = self.order[self.offsets[same_labels] + second]
+
+        diff = np.where(buckets != -1)[0]
+        anchor_labels = labels[diff]
+        n_buckets = self.bucket_bounds.shape[1] - 1
+        lo = self.bucket_bounds.ravel()[anchor_labels * (n_buckets + 1) + buckets[diff]]
+        hi = self.bucket_bounds.ravel()[anchor_labels * (n_buckets + 1) + buckets[diff] + 1]
+        position = lo + (rng.random_sample(len(diff)) * (hi - lo)).astype(np.int64)
+        found = np.searchsorted(self.diff_ends, position, side='right')
+        diff_labels = self.diff_labels[found]
+        diff_samples = self.order[self.offsets[diff_labels] + position - self.diff_starts[found]]
+        anchors = self._draw_from_labels(anchor_labels, rng)
+        redraw = np.where(self.true_ids[anchors] == self.true_ids[diff_samples])[0]
+        n_redraws = 0
+        while len(redraw) > 0:
+            n_redraws += 1
+            if n_redraws > MAX_ANCHOR_REDRAWS:
+                raise ScrnaException("Could not find anchors that are different samples from their pairs!")
+            anchors[redraw] = self._draw_from_labels(anchor_labels[redraw], rng)
+            redraw = redraw[self.true_ids[anchors[redraw]] == self.true_ids[diff_samples[redraw]]]
+        pairs[diff, 0] = anchors
+        pairs[diff, 1] = diff_samples
+        sims[diff] = self.transformed[anchor_labels, diff_labels]
+        return pairs, sims
+
+    def draw_epoch(self, rng=np.random):
+        """A complete set of pairs for one epoch."""
+        self.shuffle(rng)
+        return self.draw(slice(None), rng)
+
+
+def mine_hard_pairs(embeddings, y, true_ids, similarity, n_anchors, n_neighbors=10, rng=np.random):
+    """Pairs that are hard for the current embedding, for at most n_anchors
+    anchor samples: their nearest neighbour with a different label, and their
+    farthest of n_neighbors samples with the same label.
+    """
+    y = np.asarray(y)
+    true_ids = np.asarray(true_ids)
+    n_samples = len(y)
+    anchors = rng.choice(n_samples, min(n_samples, n_anchors), replace=False)
+
+    neighbours = NearestNeighbors(n_neighbors=min(n_neighbors + 1, n_samples)).fit(embeddings)
+    _, neighbour_ids = neighbours.kneighbors(embeddings[anchors])
+    is_negative = (y[neighbour_ids] != y[anchors, None]) & (true_ids[neighbour_ids] != true_ids[anchors, None])
+    has_negative = is_negative.any(axis=1)
+    negatives = neighbour_ids[np.arange(len(anchors)), is_negative.argmax(axis=1)][has_negative]
+    neg_anchors = anchors[has_negative]
+
+    counts = np.bincount(y)
+    order = np.argsort(y, kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    pos_anchors = anchors[counts[y[anchors]] > 1]
+    anchor_labels = y[pos_anchors, None]
+    candidates = order[offsets[anchor_labels] + (rng.random_sample((len(pos_anchors), n_neighbors)) * counts[anchor_labels]).astype(np.int64)]
+    distances = np.square(embeddings[candidates] - embeddings[pos_anchors, None]).sum(axis=2)
+    positives = candidates[np.arange(len(pos_anchors)), distances.argmax(axis=1)]
+    # Only the anchor itself was drawn
+    keep = positives != pos_anchors
+    pos_anchors, positives = pos_anchors[keep], positives[keep]
+
+    pairs = np.concatenate([np.stack([pos_anchors, positives], axis=1),
+                            np.stack([neg_anchors, negatives], axis=1)]).astype(np.int32)
+    sims = np.concatenate([np.ones(len(positives)),
+                           similarity.transformed[y[neg_anchors], y[negatives]]]).astype(np.float32)
+    print("Mined {} hard positive and {} close negative pairs".format(len(positives), len(negatives)))
+    return pairs, sims
+
+
+def mix_in_pairs(batch_pairs, batch_y, extra_pairs, extra_y, fraction, rng=np.random):
+    """Replace a fraction of a minibatch of pairs with pairs drawn at random
+    from extra_pairs (e.g. mined hard pairs). Returns new arrays.
+    """
+    n_extra = min(int(round(fraction * len(batch_pairs))), len(extra_pairs))
+    if n_extra == 0:
+        return batch_pairs, batch_y
+    chosen = rng.randint(len(extra_pairs), size=n_extra)
+    return (np.concatenate([batch_pairs[n_extra:], extra_pairs[chosen]]),
+            np.concatenate([batch_y[n_extra:], extra_y[chosen]]))
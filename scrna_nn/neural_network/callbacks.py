@@ -11,7 +11,9 @@ from keras.callbacks import Callback
 from sklearn.manifold import TSNE
 from sklearn.decomposition import PCA
 
-from ..data_manipulation.data_container import DataContainer
+from ..data_manipulation import siamese
+from ..data_manipulation.data_container import DataContainer, get_split_path
+from ..data_manipulation.row_blocks import transform_in_blocks
 
 
 class Plotter(Callback):
@@ -81,36 +83,24 @@ class TSNEPlotter(Callback):
                  data,
                  out_dir,
                  interval=1,
-                 sample_normalize=False,
-                 feature_normalize=False,
-                 feature_mean=None,
-                 feature_std=None,
-                 minmax_normalize=False,
-                 minmax_scaler=None):                 
+                 normalizer=None,
+                 cache=None,
+                 block_size=None):
         self.embedding_model = embedding_model
         self.data = data
         self.interval = interval
         with open(join(self.data, 'color_map.pickle'), 'rb') as f:
             color_map = pickle.load(f)
-        train_data = DataContainer(join(self.data, 'train_data.h5'),
-                                   sample_normalize=sample_normalize,
-                                   feature_normalize=feature_normalize,
-                                   feature_mean=feature_mean,
-                                   feature_std=feature_std,
-                                   minmax_normalize=minmax_normalize,
-                                   minmax_scaler=minmax_scaler)
-        self.X_train = train_data.get_expression_mat()
-        self.y_train = train_data.get_labels()
+        # Expression matrices are only loaded when the first plot is made
+        # (and read in blocks if block_size is given)
+        self.plot_data = DataContainer(get_split_path(self.data, 'train_data'),
+                                       normalizer=normalizer,
+                                       block_size=block_size,
+                                       cache=cache)
+        self.plot_data.add_split(get_split_path(self.data, 'valid_data'), 'valid')
+        self.y_train = self.plot_data.get_labels('train')
         self.colors_train = [color_map[y] for y in self.y_train]
-        valid_data = DataContainer(join(self.data, 'valid_data.h5'),
-                                   sample_normalize=sample_normalize,
-                                   feature_normalize=feature_normalize,
-                                   feature_mean=feature_mean,
-                                   feature_std=feature_std,
-                                   minmax_normalize=minmax_normalize,
-                                   minmax_scaler=minmax_scaler)
-        self.X_valid = valid_data.get_expression_mat()
-        self.y_valid = valid_data.get_labels()
+        self.y_valid = self.plot_data.get_labels('valid')
         self.colors_valid = [color_map[y] for y in self.y_valid]
         # build legend
         self.legend_elements = []
@@ -148,8 +138,8 @@ class TSNEPlotter(Callback):
         self.make_gif(self.combined_plot_files, join(self.out_dir, "combined.gif"))
 
     def plot(self, name):
-        X_train_embed = self.embedding_model.predict(self.X_train)
-        X_valid_embed = self.embedding_model.predict(self.X_valid)
+        X_train_embed = transform_in_blocks(self.embedding_model.predict, self.plot_data.get_expression_mat('train'))
+        X_valid_embed = transform_in_blocks(self.embedding_model.predict, self.plot_data.get_expression_mat('valid'))
         tSNE_all = TSNE().fit_transform(np.concatenate((X_train_embed, X_valid_embed), axis=0))
         # Train only
         fig, ax = plt.subplots()
@@ -191,12 +181,9 @@ class PCAPlotter(Callback):
                  data,
                  out_dir,
                  interval=1,
-                 sample_normalize=False,
-                 feature_normalize=False,
-                 feature_mean=None,
-                 feature_std=None,
-                 minmax_normalize=False,
-                 minmax_scaler=None):
+                 normalizer=None,
+                 cache=None,
+                 block_size=None):
         with open(pca_model, 'rb') as f:
             self.pca_model = pickle.load(f)
         self.embedding_model = embedding_model
@@ -204,25 +191,16 @@ class PCAPlotter(Callback):
         self.interval = interval
         with open(join(self.data, 'color_map.pickle'), 'rb') as f:
             color_map = pickle.load(f)
-        train_data = DataContainer(join(self.data, 'train_data.h5'),
-                                   sample_normalize=sample_normalize,
-                                   feature_normalize=feature_normalize,
-                                   feature_mean=feature_mean,
-                                   feature_std=feature_std,
-                                   minmax_normalize=minmax_normalize,
-                                   minmax_scaler=minmax_scaler)
-        self.X_train = train_data.get_expression_mat()
-        self.y_train = train_data.get_labels()
+        # Expression matrices are only loaded when the first plot is made
+        # (and read in blocks if block_size is given)
+        self.plot_data = DataContainer(get_split_path(self.data, 'train_data'),
+                                       normalizer=normalizer,
+                                       block_size=block_size,
+                                       cache=cache)
+        self.plot_data.add_split(get_split_path(self.data, 'valid_data'), 'valid')
+        self.y_train = self.plot_data.get_labels('train')
         self.colors_train = [color_map[y] for y in self.y_train]
-        valid_data = DataContainer(join(self.data, 'valid_data.h5'),
-                                   sample_normalize=sample_normalize,
-                                   feature_normalize=feature_normalize,
-                                   feature_mean=feature_mean,
-                                   feature_std=feature_std,
-                                   minmax_normalize=minmax_normalize,
-                                   minmax_scaler=minmax_scaler)
-        self.X_valid = valid_data.get_expression_mat()
-        self.y_valid = valid_data.get_labels()
+        self.y_valid = self.plot_data.get_labels('valid')
         self.colors_valid = [color_map[y] for y in self.y_valid]
         # build legend
         self.legend_elements = []
@@ -260,8 +238,8 @@ class PCAPlotter(Callback):
         self.make_gif(self.combined_plot_files, join(self.out_dir, "combined.gif"))
 
     def plot(self, name):
-        X_train_embed = self.embedding_model.predict(self.X_train)
-        X_valid_embed = self.embedding_model.predict(self.X_valid)
+        X_train_embed = transform_in_blocks(self.embedding_model.predict, self.plot_data.get_expression_mat('train'))
+        X_valid_embed = transform_in_blocks(self.embedding_model.predict, self.plot_data.get_expression_mat('valid'))
         pca_all = self.pca_model.transform(np.concatenate((X_train_embed, X_valid_embed), axis=0))
         # Train only
         fig, ax = plt.subplots()
@@ -297,6 +275,54 @@ class PCAPlotter(Callback):
         imageio.mimsave(out_file, images)
 
 
+class HardPairMiner(Callback):
+    """Every interval epochs, embed the training set with the current base
+    network of a siamese model and mine pairs that it finds hard (see
+    siamese.mine_hard_pairs). Until the next mining, fraction of every
+    training minibatch is drawn from the mined pairs.
+
+    The sequence switches to the mined pairs when its own epoch ends, so
+    whole epochs use the same pairs. With workers > 0, Keras' enqueuer
+    usually ends the sequence's epoch before this callback runs (it starts
+    building the next epoch's batches early), so mined pairs then take
+    effect one epoch later.
+    """
+    def __init__(self, base_model, x, y, true_ids, similarity, sequence, interval, fraction=0.5, n_anchors=10000, n_neighbors=10):
+        self.base_model = base_model
+        self.x = x
+        self.y = y
+        self.true_ids = true_ids
+        self.similarity = similarity
+        self.sequence = sequence
+        self.interval = interval
+        self.fraction = fraction
+        self.n_anchors = n_anchors
+        self.n_neighbors = n_neighbors
+
+    def on_epoch_end(self, epoch, logs={}):
+        if (epoch + 1) % self.interval != 0:
+            return
+        embeddings = transform_in_blocks(self.base_model.predict, self.x)
+        pairs, y = siamese.mine_hard_pairs(embeddings, self.y, self.true_ids, self.similarity, self.n_anchors, self.n_neighbors)
+        self.sequence.set_mined_pairs(pairs, y, self.fraction)
+
+
+class TripletMiningRefresher(Callback):
+    """Every interval epochs, embed the training set with the current model
+    and refresh the mined identities of a MinedTripletSequence.
+    """
+    def __init__(self, embedding_model, x, sequence, interval=1):
+        self.embedding_model = embedding_model
+        self.x = x
+        self.sequence = sequence
+        self.interval = interval
+
+    def on_epoch_end(self, epoch, logs={}):
+        if (epoch + 1) % self.interval != 0:
+            return
+        self.sequence.refresh(transform_in_blocks(self.embedding_model.predict, self.x))
+
+
 class LossHistory(Callback):
     def __init__(self, out_dir):
         self.out_dir = out_dir
@@ -1,7 +1,6 @@
 import numbers
 
 from keras import backend as K
-from theano import tensor as T
 
 from .. import util
 
@@ -20,7 +19,50 @@ def get_dynamic_contrastive_loss(margin=1):
             return 0.5*K.square(K.maximum((1-y_true)*margin - y_pred, 0))
     return dynamic_contrastive_loss
 
-def get_triplet_batch_hard_loss(batch_size, margin):
+def compute_batch_distances(y_true, y_pred):
+    """All-pairs distances between the embeddings of a minibatch, and
+    (float) masks of the pairs of samples with the same identity, of the
+    positive pairs (same identity, except a sample with itself) and of the
+    negative pairs. Distances use ||a||^2 + ||b||^2 - 2ab, so no B x B x D
+    tensor of differences is built.
+    """
+    # y_true holds the IDs (labels) of the samples, in its first column
+    ids = K.sum(y_true, axis=1)
+    sq_norms = K.sum(K.square(y_pred), axis=1)
+    sq_dists = K.expand_dims(sq_norms, axis=1) + K.expand_dims(sq_norms, axis=0) - 2 * K.dot(y_pred, K.transpose(y_pred))
+    dist_mat = K.sqrt(K.maximum(sq_dists, 0) + K.epsilon())
+    same_identity_mask = K.cast(K.equal(K.expand_dims(ids, axis=1), K.expand_dims(ids, axis=0)), K.floatx())
+    positions = K.arange(0, K.shape(y_pred)[0])
+    self_mask = K.cast(K.equal(K.expand_dims(positions, axis=1), K.expand_dims(positions, axis=0)), K.floatx())
+    positive_mask = same_identity_mask - self_mask
+    negative_mask = 1 - same_identity_mask
+    return dist_mat, same_identity_mask, positive_mask, negative_mask
+
+def get_batch_distances_fcn():
+    """compute_batch_distances, memoized on the (y_true, y_pred) tensors it
+    was last called with. The loss and metrics of a model are all computed
+    on the same tensors, so sharing one of these builds the distances once.
+    """
+    memo = {}
+    def batch_distances(y_true, y_pred):
+        if memo.get('y_true') is not y_true or memo.get('y_pred') is not y_pred:
+            memo.update(y_true=y_true, y_pred=y_pred, distances=compute_batch_distances(y_true, y_pred))
+        return memo['distances']
+    return batch_distances
+
+def get_triplet_loss_and_metrics(batch_size, margin):
+    """The batch-hard loss and the metrics of a triplet network (one set per
+    compiled model), sharing the distances computed on each minibatch.
+    """
+    batch_distances = get_batch_distances_fcn()
+    loss = get_triplet_batch_hard_loss(batch_size, margin, batch_distances)
+    metrics = [get_frac_active_triplet_metric(batch_size, margin, batch_distances),
+               get_embed_pos_dists_metric(batch_size, batch_distances),
+               get_embed_neg_dists_metric(batch_size, batch_distances),
+               embed_l2_metric]
+    return loss, metrics
+
+def get_triplet_batch_hard_loss(batch_size, margin, batch_distances=compute_batch_distances):
     if margin == 'soft':
         print("Using soft-margin in batch-hard loss")
         final_loss_tensor = lambda hard_pos, hard_neg: K.softplus(hard_pos - hard_neg)
@@ -34,25 +76,10 @@ def get_triplet_batch_hard_loss(batch_size, margin):
     def triplet_batch_hard_loss(y_true, y_pred):
         # y_pred is the embedding, y_true is the IDs (labels) of the samples (not 1-hot encoded)
         # They are mini-batched. If batch_size is B, and embedding dimension is D, shapes are:
-        #   y_true: (B,)
+        #   y_true: (B, 1)
         #   y_pred: (B,D)
-    
-        # Get all-pairs distances
-        y_true = K.sum(y_true, axis=1)
-        diffs = K.expand_dims(y_pred, axis=1) - K.expand_dims(y_pred, axis=0)
-        dist_mat = K.sqrt(K.sum(K.square(diffs), axis=-1) + K.epsilon())
-        same_identity_mask = K.equal(K.expand_dims(y_true, axis=1), K.expand_dims(y_true, axis=0))
-        # TODO: make this backend-agnostic somehow
-        negative_mask = T.bitwise_not(same_identity_mask)
-        # XOR ensures that the same sample is paired with itself
-        positive_mask = T.bitwise_xor(same_identity_mask, K.eye(batch_size, dtype='bool'))
-        #print(K.int_shape(y_true))
-        #print(K.int_shape(y_pred))
-
-        #positive_mask = T.bitwise_xor(same_identity_mask, T.eye(K.int_shape(y_true)[0]))
-
+        dist_mat, same_identity_mask, positive_mask, negative_mask = batch_distances(y_true, y_pred)
         furthest_positive = K.max(dist_mat*positive_mask, axis=1)
-        #closest_negative = K.min(dist_mat*negative_mask + np.inf*same_identity_mask, axis=1)
         closest_negative = K.min(dist_mat*negative_mask + 1e6*same_identity_mask, axis=1)
 
         loss = final_loss_tensor(furthest_positive, closest_negative)
@@ -60,36 +87,26 @@ def get_triplet_batch_hard_loss(batch_size, margin):
     return triplet_batch_hard_loss
 
 # METRICS (not used for parameter updates)
-def get_frac_active_triplet_metric(batch_size, margin):
+def get_frac_active_triplet_metric(batch_size, margin, batch_distances=compute_batch_distances):
     def frac_active_triplet_metric(y_true, y_pred):
-        loss = get_triplet_batch_hard_loss(batch_size, margin)(y_true, y_pred)
-        num_active = K.sum(K.greater(loss, 1e-5))
+        loss = get_triplet_batch_hard_loss(batch_size, margin, batch_distances)(y_true, y_pred)
+        num_active = K.sum(K.cast(K.greater(loss, 1e-5), K.floatx()))
         return num_active/batch_size
     return frac_active_triplet_metric
 
 def embed_l2_metric(y_true, y_pred):
     return K.sqrt(K.sum(K.square(y_pred), axis=-1))
 
-def get_embed_neg_dists_metric(batch_size):
+def get_embed_neg_dists_metric(batch_size, batch_distances=compute_batch_distances):
     def embed_neg_dists_metric(y_true, y_pred):
-        # Get all-pairs distances
-        y_true = K.sum(y_true, axis=1)
-        diffs = K.expand_dims(y_pred, axis=1) - K.expand_dims(y_pred, axis=0)
-        dist_mat = K.sqrt(K.sum(K.square(diffs), axis=-1) + K.epsilon())
-        same_identity_mask = K.equal(K.expand_dims(y_true, axis=1), K.expand_dims(y_true, axis=0))
-        negative_mask = T.bitwise_not(same_identity_mask)
+        dist_mat, _, _, negative_mask = batch_distances(y_true, y_pred)
         avg_negative_dists = K.sum(dist_mat*negative_mask, axis=-1) / K.maximum(K.sum(negative_mask, axis=1), 1)
         return avg_negative_dists
     return embed_neg_dists_metric
 
-def get_embed_pos_dists_metric(batch_size):
+def get_embed_pos_dists_metric(batch_size, batch_distances=compute_batch_distances):
     def embed_pos_dists_metric(y_true, y_pred):
-        # Get all-pairs distances
-        y_true = K.sum(y_true, axis=1)
-        diffs = K.expand_dims(y_pred, axis=1) - K.expand_dims(y_pred, axis=0)
-        dist_mat = K.sqrt(K.sum(K.square(diffs), axis=-1) + K.epsilon())
-        same_identity_mask = K.equal(K.expand_dims(y_true, axis=1), K.expand_dims(y_true, axis=0))
-        positive_mask = T.bitwise_xor(same_identity_mask, K.eye(batch_size, dtype='bool'))
+        dist_mat, _, positive_mask, _ = batch_distances(y_true, y_pred)
         avg_positive_dists = K.sum(dist_mat*positive_mask, axis=-1) / K.maximum(K.sum(positive_mask, axis=1), 1)
         return avg_positive_dists
     return embed_pos_dists_metric
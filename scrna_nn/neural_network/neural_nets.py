@@ -21,11 +21,9 @@ def save_trained_nn(model, model_path, weights_path):
 def load_trained_nn(path, triplet_loss_batch_size=-1, triplet_margin=-1, dynamic_margin=-1, siamese=False):
     custom_objects={'Sparse': Sparse, 'DenseLayerAutoencoder': DenseLayerAutoencoder}
     if triplet_loss_batch_size >= 0:
-        custom_objects['triplet_batch_hard_loss'] = losses_and_metrics.get_triplet_batch_hard_loss(triplet_loss_batch_size, triplet_margin)
-        custom_objects['frac_active_triplet_metric'] = losses_and_metrics.get_frac_active_triplet_metric(triplet_loss_batch_size, triplet_margin)
-        custom_objects['embed_pos_dists_metric'] = losses_and_metrics.get_embed_pos_dists_metric(triplet_loss_batch_size)
-        custom_objects['embed_neg_dists_metric'] = losses_and_metrics.get_embed_neg_dists_metric(triplet_loss_batch_size)
-        custom_objects['embed_l2_metric'] = losses_and_metrics.embed_l2_metric
+        loss, metrics = losses_and_metrics.get_triplet_loss_and_metrics(triplet_loss_batch_size, triplet_margin)
+        for fcn in [loss] + metrics:
+            custom_objects[fcn.__name__] = fcn
     if siamese:
         if dynamic_margin == -1:
             dynamic_margin=1
@@ -1,43 +1,119 @@
-import math
+from itertools import count
 
 import numpy as np
-from keras.utils import Sequence
 
-from .. import util
+from ..data_manipulation.data_container import SeededSequence
+from ..data_manipulation.row_blocks import take_rows
 
 
-class TripletSequence(Sequence):
-    def __init__(self, x_set, y_set, y_dim, ids_per_batch=18, samples_per_id=4, num_batches=1000):
-        # for each id in y_set, get a list of indices into x_set for that id
+class TripletSequence(SeededSequence):
+    """Batches of ids_per_batch (P) identities with samples_per_id (K)
+    samples each, for the batch-hard triplet loss. Labels are a (batch, 1)
+    column of identities. Batch buffers are reused n_buffers batches later.
+    """
+    def __init__(self, x_set, y_set, ids_per_batch=18, samples_per_id=4, num_batches=1000, n_buffers=4):
+        super(TripletSequence, self).__init__()
         self.x_set = x_set
-        self.y_set = y_set
-        self.y_dim = y_dim
         self.ids_per_batch = ids_per_batch
         self.samples_per_id = samples_per_id
         self.num_batches = num_batches
 
         self.batch_size = ids_per_batch * samples_per_id
-        self.id_dict = util.build_indices_master_list(x_set, y_set)
-        self.possible_ids = np.array(list(self.id_dict.keys()))
+        self.possible_ids, id_indices, self.id_counts = np.unique(y_set, return_inverse=True, return_counts=True)
+        self.order = np.argsort(id_indices, kind='stable')
+        self.id_offsets = np.concatenate([[0], np.cumsum(self.id_counts)[:-1]])
         print("possible_ids.shape: ", self.possible_ids.shape)
-        
+        self.x_buffers = np.zeros((n_buffers, self.batch_size, self.x_set.shape[1]), dtype=np.float32)
+        self.y_buffers = np.zeros((n_buffers, self.batch_size, 1), dtype=np.float32)
+        # Buffers are handed out in the order batches are built (which
+        # continues across epochs, unlike idx)
+        self.buffer_counter = count()
+
     def __len__(self):
         return self.num_batches
 
+    def select_ranks(self, counts, rng=np.random):
+        """For each identity (with counts samples), the ranks of K samples
+        among its samples. Identities with at most K samples use every
+        sample (some of them repeatedly), others K distinct samples.
+        """
+        K = self.samples_per_id
+        ranks = (rng.random_sample((len(counts), K)) * counts[:, None]).astype(np.int64)
+        few = counts <= K
+        shifts = (rng.random_sample(np.sum(few)) * counts[few]).astype(np.int64)
+        ranks[few] = (np.arange(K) + shifts[:, None]) % counts[few, None]
+        # Redraw the identities that drew a sample twice
+        while True:
+            sorted_ranks = np.sort(ranks, axis=1)
+            redraw = np.where((sorted_ranks[:, 1:] == sorted_ranks[:, :-1]).any(axis=1) & ~few)[0]
+            if len(redraw) == 0:
+                return ranks
+            ranks[redraw] = (rng.random_sample((len(redraw), K)) * counts[redraw, None]).astype(np.int64)
+
+    def select_ids(self, rng=np.random):
+        """Indices (into possible_ids) of the identities of a batch."""
+        return rng.choice(len(self.possible_ids), self.ids_per_batch,
+                          replace=self.ids_per_batch > len(self.possible_ids))
+
     def __getitem__(self, idx):
-        X = np.zeros((self.batch_size, self.x_set.shape[1]), dtype='float32')
-        y = np.zeros((self.batch_size, self.y_dim), dtype='float32')
-        if self.ids_per_batch <= len(self.possible_ids):
-            selected_ids = np.random.choice(self.possible_ids, self.ids_per_batch, replace=False)
+        rng = self.batch_rng(idx)
+        selected = self.select_ids(rng)
+        ranks = self.select_ranks(self.id_counts[selected], rng)
+        batch_indices = self.order[(self.id_offsets[selected, None] + ranks).ravel()]
+        buffer_idx = next(self.buffer_counter) % len(self.x_buffers)
+        X = self.x_buffers[buffer_idx]
+        y = self.y_buffers[buffer_idx]
+        # Gather all rows of the batch at once (only these rows are read if
+        # x_set is an out-of-core matrix, or densified if it is sparse)
+        if isinstance(self.x_set, np.ndarray):
+            np.take(self.x_set, batch_indices, axis=0, out=X)
+        else:
+            X[:] = take_rows(self.x_set, batch_indices)
+        y[:, 0] = np.repeat(self.possible_ids[selected], self.samples_per_id)
+        return X, y
+
+
+class MinedTripletSequence(TripletSequence):
+    """A TripletSequence whose batches are a random identity and the
+    ids_per_batch - 1 identities mined for it (see refresh):
+        'hard' - the identities with the nearest centroids
+        'semi-hard' - the nearest identities farther than the identity's own
+            spread (the nearest others fill in if there are too few)
+    """
+    def __init__(self, x_set, y_set, ids_per_batch=18, samples_per_id=4, num_batches=1000, n_buffers=4, mining='hard'):
+        super(MinedTripletSequence, self).__init__(x_set, y_set, ids_per_batch, samples_per_id, num_batches, n_buffers)
+        self.mining = mining
+        self.neighbour_ids = None
+
+    def refresh(self, embeddings):
+        """Mine the neighbour identities of every identity, given the
+        embeddings of every sample of x_set.
+        """
+        if self.ids_per_batch >= len(self.possible_ids):
+            # Every batch has every identity anyway
+            return
+        grouped = embeddings[self.order]
+        centroids = np.add.reduceat(grouped, self.id_offsets, axis=0) / self.id_counts[:, None]
+        spread = np.add.reduceat(np.linalg.norm(grouped - np.repeat(centroids, self.id_counts, axis=0), axis=1),
+                                 self.id_offsets) / self.id_counts
+        sq_norms = np.square(centroids).sum(axis=1)
+        centroid_dists = np.sqrt(np.maximum(sq_norms[:, None] + sq_norms[None, :] - 2 * centroids.dot(centroids.T), 0))
+        np.fill_diagonal(centroid_dists, np.inf)
+        if self.mining == 'semi-hard':
+            # Rank identities within the spread after all others (and the
+            # identity itself, at an infinite distance, last)
+            too_close = centroid_dists <= spread[:, None]
+            np.fill_diagonal(too_close, True)
+            ranking = np.lexsort((centroid_dists, too_close), axis=1)
         else:
-            selected_ids = np.random.choice(self.possible_ids, self.ids_per_batch, replace=True)
-        for i, cur_id in enumerate(selected_ids):
-            cur_id_samples = np.array(self.id_dict[cur_id])
-            count = cur_id_samples.shape[0]
-            num_to_take = math.ceil(self.samples_per_id/count) * count
-            padded_list_indexer = np.mod(np.arange(num_to_take), count)
-            selection = np.random.choice(padded_list_indexer, self.samples_per_id, replace=False)
-            selected = cur_id_samples[selection]
-            X[i*self.samples_per_id:(i+1)*self.samples_per_id, :] = self.x_set[selected]
-            y[i*self.samples_per_id:(i+1)*self.samples_per_id, 0] = cur_id
-        return X, y        
+            ranking = np.argsort(centroid_dists, axis=1)
+        self.neighbour_ids = ranking[:, :self.ids_per_batch - 1]
+        nearest = centroid_dists.min(axis=1)
+        print("Mined {} triplet neighbours: mean nearest centroid distance {:.4f}, mean spread {:.4f}".format(
+            self.mining, np.mean(nearest), np.mean(spread)))
+
+    def select_ids(self, rng=np.random):
+        if self.neighbour_ids is None:
+            return super(MinedTripletSequence, self).select_ids(rng)
+        anchor_id = rng.randint(len(self.possible_ids))
+        return np.concatenate([[anchor_id], self.neighbour_ids[anchor_id]])
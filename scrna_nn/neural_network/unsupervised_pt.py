@@ -1,3 +1,4 @@
+import os
 from os.path import join
 
 import keras
@@ -9,27 +10,84 @@ from keras.models import Model
 from sparsely_connected_keras import Sparse
 from tied_autoencoder_keras import DenseLayerAutoencoder, SparseLayerAutoencoder
 
-NOISE_LEVEL = 0.1
+from .. import util
+from ..data_manipulation.data_container import DenoisingSequence
+from ..data_manipulation.row_blocks import iter_row_blocks
 
-def get_embedder(model, i, opt, args):
-    #inputs = Input(shape=(input_dim,))
-    embedder = Model(inputs=model.layers[0].input, outputs=model.layers[i-1].output)
-    print("Embedder architecture:")
-    print(embedder.summary())
-    embedder.compile(loss='mean_squared_error', optimizer=opt)
-    return embedder
+# Activations larger than this are kept in a memmapped file on disk
+ACTIVATIONS_IN_MEMORY_BYTES = 1 << 30
+ACTIVATIONS_FILE = 'pretrain_activations_{}.dat'
+
+def get_feed_forward(layers, input_dim):
+    """A model applying layers (already trained) to their inputs. It is only
+    used for predict, so it is not compiled.
+    """
+    inputs = Input(shape=(input_dim,))
+    x = inputs
+    for layer in layers:
+        x = layer(x)
+    return Model(inputs=inputs, outputs=x)
+
+def feed_forward(layers, X, path):
+    """The float32 outputs of layers for every row of X, computed one block of
+    rows at a time. Outputs larger than ACTIVATIONS_IN_MEMORY_BYTES are
+    written to a memmap at path.
+    """
+    feed_forward_model = get_feed_forward(layers, X.shape[1])
+    shape = (X.shape[0], feed_forward_model.output_shape[-1])
+    if shape[0] * shape[1] * np.dtype(np.float32).itemsize > ACTIVATIONS_IN_MEMORY_BYTES:
+        print("Writing {} activations to {}".format(shape, path))
+        activations = np.memmap(path, dtype=np.float32, mode='w+', shape=shape)
+    else:
+        activations = np.empty(shape, dtype=np.float32)
+    start = 0
+    for block in iter_row_blocks(X):
+        activations[start:start + len(block)] = feed_forward_model.predict(block)
+        start += len(block)
+    return activations
+
+def release_activations(activations):
+    """Delete the file behind activations, if they are memmapped."""
+    if isinstance(activations, np.memmap):
+        os.remove(activations.filename)
 
 def pretrain_model(model, input_dim, opt, X_orig, working_dir, args):
+    """Greedily pretrain each Dense or Sparse layer of model as a denoising
+    autoencoder of the outputs of the (pretrained and frozen) layers before
+    it. The outputs of the previous stage are kept, so each stage only feeds
+    them through the layers added since, and not the whole network again.
+    """
+    embedded_data = None
+    n_embedded = 1 # layers before this one have been applied to embedded_data
     for i in range(1, len(model.layers)):
         print("GLUP layer {}".format(i))
         if not isinstance(model.layers[i], (Dense, Sparse)):
             print("layer {}:{} is not a Dense or Sparse layer, skipping".format(i, type(model.layers[i])))
             continue
-        embedder = get_embedder(model, i, opt, args)
-        embedded_data = embedder.predict(X_orig)
-        corrupted = embedded_data + NOISE_LEVEL * \
-        np.random.normal(loc=0, scale=1, size=embedded_data.shape)
-        inputs = Input(shape=(embedded_data.shape[1],))
+        if i > n_embedded:
+            previous = X_orig if embedded_data is None else embedded_data
+            embedded_data = feed_forward(model.layers[n_embedded:i], previous,
+                                         join(working_dir, ACTIVATIONS_FILE.format(i)))
+            if previous is not X_orig:
+                release_activations(previous)
+            del previous
+            n_embedded = i
+        # The first layer is trained on X_orig itself (not a copy of it)
+        layer_input = X_orig if embedded_data is None else embedded_data
+        # The last args.valid fraction of rows is held out (as validation_split
+        # did). Noise is added to each minibatch as it is drawn.
+        n_train = layer_input.shape[0] - int(layer_input.shape[0] * args.valid)
+        train_sequence = DenoisingSequence(layer_input, args.batch_size, "train",
+                                           args.noise_type, args.noise_level,
+                                           n_buffers=util.get_n_batch_buffers(args),
+                                           rows=slice(0, n_train))
+        valid_sequence = None
+        if n_train < layer_input.shape[0]:
+            valid_sequence = DenoisingSequence(layer_input, args.batch_size, "valid",
+                                               args.noise_type, args.noise_level, shuffle=False,
+                                               n_buffers=util.get_n_batch_buffers(args),
+                                               rows=slice(n_train, None))
+        inputs = Input(shape=(layer_input.shape[1],))
         if isinstance(model.layers[i], Sparse):
             x = SparseLayerAutoencoder(
                 activation=args.act,
@@ -48,17 +106,21 @@ def pretrain_model(model, input_dim, opt, X_orig, working_dir, args):
                     monitor='val_loss',
                     patience=2,
                     verbose=1)]
-        dae.fit(
-            embedded_data,
-            corrupted,
-            batch_size=args.batch_size,
+        # Learn to reconstruct the clean data from the corrupted data
+        dae.fit_generator(
+            train_sequence,
             epochs=args.epochs,
             verbose=1,
-            validation_split=args.valid,
-            callbacks=callbacks_list)
+            validation_data=valid_sequence,
+            callbacks=callbacks_list,
+            shuffle=False,
+            **util.get_generator_options(args))
         if isinstance(model.layers[i], Sparse):
             model.layers[i].set_weights(dae.layers[1].get_weights()[1:])
         else:
             model.layers[i].set_weights(dae.layers[1].get_weights()[:2])
         model.layers[i].trainable = False
+        del train_sequence, valid_sequence, layer_input
+    if embedded_data is not None:
+        release_activations(embedded_data)
     model.save_weights(join(working_dir, 'pretrained_layer_weights.h5'))
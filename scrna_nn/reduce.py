@@ -8,7 +8,10 @@ import pandas as pd
 from keras import backend as K
 
 from .util import cli
+from .util.cache import get_preprocessed_cache
 from .data_manipulation.data_container import DataContainer
+from .data_manipulation.normalization import load_normalizer
+from .data_manipulation.row_blocks import HDF5_LOCK, transform_in_blocks
 from .neural_network import neural_nets as nn
 
 
@@ -19,29 +22,24 @@ def save_reduced_data_to_h5(filename, X_reduced, data_container, save_metadata):
         remove(filename)
     if dirname(filename) != '':
         makedirs(dirname(filename), exist_ok=True)
-    h5_store = pd.HDFStore(filename)
-    h5_store['rpkm'] = pd.DataFrame(data=X_reduced, index=data_container.splits['train']['rpkm_df'].index)
-    if save_metadata:
-        print("saving metadata as well...")
-        # Note: Does not make sense to save gene_symbols because our columns are no longer
-        # genes, they are some reduced dimension.
-        h5_store['labels'] = data_container.splits['train']['labels_series']
-        h5_store['accessions'] = data_container.splits['train']['accessions_series']
-    h5_store.close()
+    with HDF5_LOCK:
+        h5_store = pd.HDFStore(filename)
+        h5_store['rpkm'] = pd.DataFrame(data=X_reduced, index=data_container.get_cell_ids())
+        if save_metadata:
+            print("saving metadata as well...")
+            # Note: Does not make sense to save gene_symbols because our columns are no longer
+            # genes, they are some reduced dimension.
+            h5_store['labels'] = data_container.get_metadata('labels_series')
+            h5_store['accessions'] = data_container.get_metadata('accessions_series')
+        h5_store.close()
 
 
-def _reduce_helper(trained_model_folder, data_to_reduce):
+def _reduce_helper(trained_model_folder, data_to_reduce, block_size=None, cache=None, as_sparse=False):
     training_args_path = join(trained_model_folder, "command_line_args.txt")
     training_args = cli.load_cmd_args_from_file(training_args_path)
     # Must ensure that we use the same normalizations/standardization from when model was trained
-    mean = None
-    std = None
-    feature_normalize = False
-    if training_args.gn:
-        feature_normalize = True
-        mean = pd.read_pickle(join(trained_model_folder, "mean.p"))
-        std = pd.read_pickle(join(trained_model_folder, "std.p"))
-    data_container = DataContainer(data_to_reduce, sample_normalize=training_args.sn, feature_normalize=feature_normalize, feature_mean=mean, feature_std=std)
+    normalizer = load_normalizer(trained_model_folder, training_args)
+    data_container = DataContainer(data_to_reduce, normalizer=normalizer, block_size=block_size, cache=cache, as_sparse=as_sparse)
     X = data_container.get_expression_mat()
     if training_args.nn:
         if training_args.triplet:
@@ -72,17 +70,17 @@ def _reduce_helper(trained_model_folder, data_to_reduce):
         if training_args.nn == "DAE":
             embedded = model.layers[1].encode(model.layers[0].input)
             get_activations = K.function([model.layers[0].input], [embedded])
-        X_transformed = get_activations([X])[0]
+        X_transformed = transform_in_blocks(lambda block: get_activations([block])[0], X)
     else:
         # Use PCA
         with open(join(trained_model_folder, "pca.p"), 'rb') as f:
             model = pickle.load(f)
-        X_transformed = model.transform(X)
+        X_transformed = transform_in_blocks(model.transform, X)
     print("reduced dimensions to: ", X_transformed.shape)
     return X_transformed, data_container
     
 def reduce(args):
-    X_transformed, original_data_container = _reduce_helper(args.trained_model_folder, args.data)
+    X_transformed, original_data_container = _reduce_helper(args.trained_model_folder, args.data, args.block_size, get_preprocessed_cache(args), args.sparse)
     save_reduced_data_to_h5(args.out, X_transformed, original_data_container, args.save_meta)
     # with open(join(working_dir_path, "training_command_line_args.json"), 'w') as fp:
     #     json.dump(training_args, fp)
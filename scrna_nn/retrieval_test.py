@@ -7,6 +7,7 @@ from scipy.spatial import distance
 
 from .data_manipulation.data_container import DataContainer
 from .util import create_working_directory, distances
+from .util.cache import get_preprocessed_cache, get_siamese_cache
 
 
 # def average_accuracy(query_label, retrieved_labels, dist_mat_by_strings, max_dist):
@@ -15,28 +16,23 @@ from .util import create_working_directory, distances
 #         avg_acc += max(0, 1 - (dist_mat_by_strings[query_label][r] / max_dist))
 #     return avg_acc/len(retrieved_labels)
 
-def average_flex_precision(query_label, retrieved_labels, similarity_fcn, is_asymm):
+def average_flex_precision(query_id, retrieved_ids, similarity, is_asymm):
     """The difference between this and 'average_flex_precision' is that while that function
     only calculated a score at recall positions that were perfect matches, this one calculates
     at every position. (the other function will return 0 if there were no perfect matches).
+
+    Labels are given as integer ids into the (transformed) similarity matrix
+    of a distances.SimilarityMatrix, and all relevances are looked up at once.
     """
-    scores = []
-    relevance_sum = 0
-    for idx, retrieved in enumerate(retrieved_labels):
-        if retrieved == query_label:
-            relevance_sum += 1
-            scores.append(relevance_sum / float(idx+1))
-        else:
-            try:
-                relevance = similarity_fcn(query_label, retrieved)
-                if is_asymm:
-                    relevance = min(relevance, similarity_fcn(retrieved, query_label))
-                relevance_sum += relevance
-                scores.append(relevance_sum / float(idx+1))
-            except KeyError as err:
-                # no similarity information available (not in dict), skip
-                pass
-        
+    relevance = similarity.transformed[query_id, retrieved_ids]
+    if is_asymm:
+        relevance = np.minimum(relevance, similarity.transformed[retrieved_ids, query_id])
+    relevance = np.where(retrieved_ids == query_id, 1.0, relevance)
+    # no similarity information available (NaN), skip that position
+    available = ~np.isnan(relevance)
+    relevance_sum = np.cumsum(np.where(available, relevance, 0.0))
+    positions = np.arange(1, len(retrieved_ids) + 1)
+    scores = relevance_sum[available] / positions[available]
     if len(scores) > 0:
         return np.mean(scores)
     else:
@@ -68,7 +64,7 @@ def average_precision(target, retrieved_list):
         avg_precision /= float(correct)
     return avg_precision
 
-def retrieval_test_in_memory(db, db_labels, query, query_labels):
+def retrieval_test_in_memory(db, db_labels, query, query_labels, similarity_cache=None):
     similarity_fcn = distances.TextMinedPairSimilarity(distance_mat_file='dump_A_1.p',
                                                        transform='linear',
                                                        transform_param=1)
@@ -88,13 +84,21 @@ def retrieval_test_in_memory(db, db_labels, query, query_labels):
     average_precisions_for_label = defaultdict(list)
     average_flex_precisions_for_label = defaultdict(list)
 
+    if similarity_cache is None:
+        similarity = similarity_fcn.compile(np.union1d(db_uniq, query_uniq))
+    else:
+        similarity = similarity_fcn.compile_cached(np.union1d(db_uniq, query_uniq), similarity_cache)
+    db_label_ids = similarity.label_ids(db_labels)
+    query_label_ids = similarity.label_ids(query_labels)
+
     distance_matrix = distance.cdist(query, db, metric='euclidean')
     for index, distances_to_query in enumerate(distance_matrix): # Loop is over the set of query cells
         query_label = query_labels[index]
         sorted_distances_indices = np.argsort(distances_to_query)
         retrieved_labels_sorted_by_distance = db_labels[sorted_distances_indices]
         retrieved_labels = retrieved_labels_sorted_by_distance[:num_results]
-        avg_flex_precision = average_flex_precision(query_label, retrieved_labels, similarity_fcn, True)
+        retrieved_label_ids = db_label_ids[sorted_distances_indices[:num_results]]
+        avg_flex_precision = average_flex_precision(query_label_ids[index], retrieved_label_ids, similarity, True)
         avg_precision = average_precision(query_label, retrieved_labels)
         average_precisions_for_label[query_label].append(avg_precision)
         average_flex_precisions_for_label[query_label].append(avg_flex_precision)
@@ -141,8 +145,9 @@ def retrieval_test(args):
     
     working_dir_path = create_working_directory(args.out, "retrieval_results/")
     # Load the reduced data
-    query_data = DataContainer(args.query_data_file)
-    database_data = DataContainer(args.database_data_file)
+    preprocessed_cache = get_preprocessed_cache(args)
+    query_data = DataContainer(args.query_data_file, cache=preprocessed_cache)
+    database_data = DataContainer(args.database_data_file, cache=preprocessed_cache)
     queries = query_data.get_expression_mat()
     db = database_data.get_expression_mat()
     queries_labels = query_data.get_labels()
@@ -171,6 +176,10 @@ def retrieval_test(args):
         data_summary_f.write("\nmin number of cells of any single type in DB: " + str(min_db_label_count) + '\n')
         num_results = min(100, min_db_label_count)
 
+    similarity = similarity_fcn.compile_cached(np.union1d(db_uniq, query_uniq), get_siamese_cache(args))
+    db_label_ids = similarity.label_ids(db_labels)
+    queries_label_ids = similarity.label_ids(queries_labels)
+
     average_precisions_for_label = defaultdict(list)
     average_flex_precisions_for_label = defaultdict(list)
     all_average_precisions = []
@@ -184,10 +193,11 @@ def retrieval_test(args):
         sorted_distances_indices = np.argsort(distances_to_query)
         retrieved_labels_sorted_by_distance = db_labels[sorted_distances_indices]
         retrieved_labels = retrieved_labels_sorted_by_distance[:num_results]
+        retrieved_label_ids = db_label_ids[sorted_distances_indices[:num_results]]
         # avg_accuracy = average_accuracy(query_label, retrieved_labels, dist_mat_by_strings, int(args['--max_ont_dist']))
         # top_fourth_idx = int(num_results/4)
         # avg_accuracy_of_top_fourth = average_accuracy(query_label, retrieved_labels[:top_fourth_idx], dist_mat_by_strings, int(args['--max_ont_dist']))
-        avg_flex_precision = average_flex_precision(query_label, retrieved_labels, similarity_fcn, args.asymm_dist)
+        avg_flex_precision = average_flex_precision(queries_label_ids[index], retrieved_label_ids, similarity, args.asymm_dist)
         #  avg_flex_precision2 = average_flex_precision2(query_label, retrieved_labels, dist_mat_by_strings, int(args['--max_ont_dist']))
         avg_precision = average_precision(query_label, retrieved_labels)
         if avg_flex_precision <= 0.2:
@@ -12,12 +12,16 @@ from keras.optimizers import SGD, RMSprop, Adam
 from keras.utils import multi_gpu_model
 from keras.models import Model
 from keras.layers import Lambda, Input
-from sklearn.decomposition import PCA
+from scipy import sparse
+from sklearn.decomposition import PCA, IncrementalPCA
 from sklearn.linear_model import LogisticRegression
 from sklearn.metrics import accuracy_score, log_loss
 
 from . import util
-from .data_manipulation.data_container import DataContainer, ExpressionSequence
+from .util import cache
+from .data_manipulation import normalization
+from .data_manipulation.data_container import DataContainer, DenoisingSequence, ExpressionSequence, ResampledPairSequence, SiamesePairSequence, get_split_path
+from .data_manipulation.row_blocks import iter_row_blocks, requires_blocks, transform_in_blocks
 from .neural_network import callbacks
 from .neural_network import losses_and_metrics
 from .neural_network import neural_nets as nn
@@ -129,16 +133,12 @@ def compile_model(model, args, optimizer):
     elif args.triplet:
         batch_size = args.batch_hard_P * args.batch_hard_K
         margin = args.batch_hard_margin
-        loss = losses_and_metrics.get_triplet_batch_hard_loss(batch_size, margin)
-        frac_active_triplets = losses_and_metrics.get_frac_active_triplet_metric(
-            batch_size, margin)
-        avg_pos_dists = losses_and_metrics.get_embed_pos_dists_metric(batch_size)
-        avg_neg_dists = losses_and_metrics.get_embed_neg_dists_metric(batch_size)
-        metrics = [frac_active_triplets, avg_pos_dists, avg_neg_dists, losses_and_metrics.embed_l2_metric]
+        loss, metrics = losses_and_metrics.get_triplet_loss_and_metrics(batch_size, margin)
     elif args.nn == "DAE":
         loss = 'mean_squared_error'
     else:
-        loss = 'categorical_crossentropy'
+        # Labels are integer ids rather than one-hot vectors
+        loss = 'sparse_categorical_crossentropy'
         metrics = ['accuracy']
     model.compile(loss=loss, optimizer=optimizer, metrics=metrics)
 
@@ -157,15 +157,29 @@ def plot_accuracy_history(history, path):
 
 def train_pca_model(working_dir_path, args, data):
     print('Training a PCA model...')
-    model = PCA(n_components=args.pca)
     X = data.get_expression_mat('train')
-    model.fit(X)
+    if requires_blocks(X):
+        # Fit on one (dense) block at a time for out-of-core or sparse data
+        model = IncrementalPCA(n_components=args.pca)
+        for block in iter_row_blocks(X):
+            model.partial_fit(block)
+    else:
+        model = PCA(n_components=args.pca)
+        model.fit(X)
     if not args.no_save:
         with open(join(working_dir_path, 'pca.p'), 'wb') as f:
             pickle.dump(model, f)
     return model
 
 
+def share_splits(args, data, splits):
+    # Worker processes attach to the splits instead of each receiving a
+    # pickled copy of them
+    if args.use_multiprocessing and args.workers > 0:
+        for split in splits:
+            data.share_split(split)
+
+
 def fit_neural_net(model, args, data, callbacks_list, working_dir_path):
     if args.triplet:
         history = fit_triplet_neural_net(model, args, data, callbacks_list)
@@ -186,28 +200,41 @@ def fit_neural_net(model, args, data, callbacks_list, working_dir_path):
     else:
         if args.siamese:
             # Specially routines for training siamese models
-            data.create_siamese_data(args)
-            X_train = data.splits['train']['siam_X']
-            y_train = data.splits['train']['siam_y']
-            X_valid = data.splits['valid']['siam_X']
-            y_valid = data.splits['valid']['siam_y']
-        else:
-            if args.nn == "DAE":
-                X_train, y_train = data.get_data_for_neural_net_unsupervised('train', args.noise_level)
-                X_valid, y_valid = data.get_data_for_neural_net_unsupervised('valid', args.noise_level)
+            if args.resample_pairs:
+                # Draw new training pairs every epoch, validate on a fixed set
+                data.create_siamese_data(args, splits=[split for split in data.get_split_names() if split != 'train'])
+                X_train, y_train = data.get_expression_mat('train'), None
+                train_sequence = ResampledPairSequence(X_train, data.create_pair_sampler(args, 'train'), args.batch_size, "train")
             else:
-                X_train, y_train = data.get_data_for_neural_net(
-                    'train', one_hot=True)
-                X_valid, y_valid = data.get_data_for_neural_net(
-                    'valid', one_hot=True)
+                data.create_siamese_data(args)
+                X_train, pairs_train, y_train = data.get_siamese_data('train')
+                train_sequence = SiamesePairSequence(X_train, pairs_train, y_train, args.batch_size, "train")
+            X_valid, pairs_valid, y_valid = data.get_siamese_data('valid')
+            valid_sequence = SiamesePairSequence(X_valid, pairs_valid, y_valid, args.batch_size, "valid")
+            if args.online_train:
+                # Bias training pairs toward ones the current embedding gets wrong
+                label_ids, similarity = data.get_siamese_labels(args, 'train')
+                callbacks_list.append(callbacks.HardPairMiner(
+                    model.layers[2], X_train, label_ids, data.get_true_ids('train'), similarity,
+                    train_sequence, args.online_train, args.hard_pair_frac,
+                    args.hard_pair_anchors, args.hard_pair_neighbors))
+        elif args.nn == "DAE":
+            # Noise is added to each minibatch as it is drawn
+            X_train, y_train = data.get_expression_mat('train'), None
+            X_valid, y_valid = data.get_expression_mat('valid'), None
+            train_sequence = DenoisingSequence(X_train, args.batch_size, "train", args.noise_type, args.noise_level, n_buffers=util.get_n_batch_buffers(args))
+            valid_sequence = DenoisingSequence(X_valid, args.batch_size, "valid", args.noise_type, args.noise_level, n_buffers=util.get_n_batch_buffers(args))
+        else:
+            X_train, y_train = data.get_data_for_neural_net('train')
+            X_valid, y_valid = data.get_data_for_neural_net('valid')
             print('Train data shapes:')
             print(X_train.shape)
             print(y_train.shape)
             print('Valid data shapes:')
             print(X_valid.shape)
             print(y_valid.shape)
-        train_sequence = ExpressionSequence(X_train, y_train, args.batch_size, "train")
-        valid_sequence = ExpressionSequence(X_valid, y_valid, args.batch_size, "valid")
+            train_sequence = ExpressionSequence(X_train, y_train, args.batch_size, "train", n_buffers=util.get_n_batch_buffers(args))
+            valid_sequence = ExpressionSequence(X_valid, y_valid, args.batch_size, "valid", n_buffers=util.get_n_batch_buffers(args))
         del X_train, y_train, X_valid, y_valid
         history = model.fit_generator(train_sequence,
                                       steps_per_epoch=args.batches_per_epoch,
@@ -215,7 +242,8 @@ def fit_neural_net(model, args, data, callbacks_list, working_dir_path):
                                       callbacks=callbacks_list,
                                       validation_data=valid_sequence,
                                       verbose=2,
-                                      shuffle=False)
+                                      shuffle=False,
+                                      **util.get_generator_options(args))
         # history = model.fit(
         #     X_train,
         #     y_train,
@@ -231,23 +259,30 @@ def fit_neural_net(model, args, data, callbacks_list, working_dir_path):
 
 def fit_triplet_neural_net(model, args, data, callbacks_list):
     print(model.summary())
-    embedding_dim = model.layers[-1].output_shape[1]
     P = args.batch_hard_P
     K = args.batch_hard_K
     num_batches = args.num_batches
     num_batches_val = args.num_batches_val
-    X_train, y_train = data.get_data_for_neural_net('train', one_hot=False)
-    X_valid, y_valid = data.get_data_for_neural_net('valid', one_hot=False)
-    train_data = triplet.TripletSequence(
-        X_train, y_train, embedding_dim, P, K, num_batches)
+    X_train, y_train = data.get_data_for_neural_net('train')
+    X_valid, y_valid = data.get_data_for_neural_net('valid')
+    if args.triplet_mining != 'none':
+        # Build batches from identities that are close in the embedding
+        train_data = triplet.MinedTripletSequence(
+            X_train, y_train, P, K, num_batches, util.get_n_batch_buffers(args), args.triplet_mining)
+        callbacks_list.append(callbacks.TripletMiningRefresher(
+            model, X_train, train_data, args.triplet_mining_int))
+    else:
+        train_data = triplet.TripletSequence(
+            X_train, y_train, P, K, num_batches, util.get_n_batch_buffers(args))
     valid_data = triplet.TripletSequence(
-        X_valid, y_valid, embedding_dim, P, K, num_batches_val)
+        X_valid, y_valid, P, K, num_batches_val, util.get_n_batch_buffers(args))
     history = model.fit_generator(
         train_data,
         epochs=args.epochs,
         verbose=1,
         callbacks=callbacks_list,
-        validation_data=valid_data)
+        validation_data=valid_data,
+        **util.get_generator_options(args))
     return history
 
 
@@ -315,6 +350,7 @@ def layerwise_train_neural_net(working_dir_path, args, data, training_report):
     # Set up optimizer
     opt = get_optimizer(args)
     # Get unlabeled data
+    share_splits(args, data, ['train'])
     X = data.get_expression_mat()
     # Construct network architecture
     input_dim, output_dim = X.shape[1], None
@@ -327,13 +363,13 @@ def layerwise_train_neural_net(working_dir_path, args, data, training_report):
 def train_LR(feature_model, args, data, training_report):
     lr = LogisticRegression(multi_class='multinomial', max_iter=1000, solver='sag')
     for split in ['train', 'valid', 'test']:
-        X, y = data.get_data_for_neural_net(split, one_hot=False)
-        X, y_one_hot = data.get_data_for_neural_net(split, one_hot=True)
-        X = feature_model.transform(X)
+        X, y = data.get_data_for_neural_net(split)
+        X = transform_in_blocks(feature_model.transform, X)
         if split == 'train':
             print("Fitting LR model")
             lr.fit(X, y)
-        loss = log_loss(y_one_hot, lr.predict_proba(X))
+        # Columns of predict_proba are lr.classes_, which a split may not all have
+        loss = log_loss(y, lr.predict_proba(X), labels=lr.classes_)
         acc = accuracy_score(y, lr.predict(X))
         training_report['res_{}_loss'.format(split)] = loss
         print('{}\tLR loss\t{}'.format(split, loss))
@@ -346,14 +382,16 @@ def evaluate_pca_model(model, args, data, training_report):
     # Retrieval testing
     print("Conducting retrieval testing...")
     database = data.get_expression_mat(split='train')
-    database = model.transform(database)
+    database = transform_in_blocks(model.transform, database)
+    data.release_split('train')
     database_labels = data.get_labels('train')
     for split in ['valid', 'test']:
         query = data.get_expression_mat(split)
-        query = model.transform(query)
+        query = transform_in_blocks(model.transform, query)
+        data.release_split(split)
         query_labels = data.get_labels(split)
         avg_map, wt_avg_map, avg_mafp, wt_avg_mafp = retrieval_test_in_memory(
-            database, database_labels, query, query_labels)
+            database, database_labels, query, query_labels, cache.get_siamese_cache(args))
         training_report['res_{}_avg_map'.format(split)] = avg_map
         training_report['res_{}_wt_avg_map'.format(split)] = wt_avg_map
         training_report['res_{}_avg_mafp'.format(split)] = avg_mafp
@@ -370,24 +408,35 @@ def evaluate_model(model, args, data, training_report):
         # if checkpointing was used, then make sure we use the 'best'
         # model for evaluation
         model.load_weights(join(training_report['cfg_folder'], 'model_weights.h5'))
-    for split in data.splits.keys():
+    for split in data.get_split_names():
         if args.siamese:
-            X = data.splits[split]['siam_X']
-            y = data.splits[split]['siam_y']
+            X, pairs, y = data.get_siamese_data(split)
         else:
             if args.nn == "DAE":
-                X, y = data.get_data_for_neural_net_unsupervised(split, args.noise_level)
+                X, y = data.get_expression_mat(split), None
             else:
-                X, y = data.get_data_for_neural_net(split, one_hot=not args.triplet)
+                X, y = data.get_data_for_neural_net(split)
         if args.triplet:
             # TODO: remove copy/pasted code
-            embedding_dim = model.layers[-1].output_shape[1]
             bh_P = args.batch_hard_P
             bh_K = args.batch_hard_K
             num_batches = args.num_batches_val
             eval_data = triplet.TripletSequence(
-                X, y, embedding_dim, bh_P, bh_K, num_batches)
-            eval_results = model.evaluate_generator(eval_data, verbose=1)
+                X, y, bh_P, bh_K, num_batches, util.get_n_batch_buffers(args))
+            eval_results = model.evaluate_generator(eval_data, verbose=1, **util.get_generator_options(args))
+        elif args.siamese:
+            eval_results = model.evaluate_generator(
+                SiamesePairSequence(X, pairs, y, args.batch_size, split, shuffle=False),
+                **util.get_generator_options(args))
+        elif args.nn == "DAE":
+            eval_results = model.evaluate_generator(
+                DenoisingSequence(X, args.batch_size, split, args.noise_type, args.noise_level, shuffle=False),
+                **util.get_generator_options(args))
+        elif sparse.issparse(X):
+            # Only densify one batch at a time
+            eval_results = model.evaluate_generator(
+                ExpressionSequence(X, y, args.batch_size, split, shuffle=False),
+                **util.get_generator_options(args))
         else:
             eval_results = model.evaluate(x=X, y=y)
         try:  # Ensure eval_results is iterable
@@ -419,14 +468,17 @@ def evaluate_model(model, args, data, training_report):
         else:
             last_hidden_layer = reducing_model.layers[-2]
         embedder = Model(inputs=reducing_model.layers[0].input, outputs=last_hidden_layer.output)
-    database = embedder.predict(database)
+    database = transform_in_blocks(embedder.predict, database)
+    # Only the embeddings are needed from here on, so free the raw matrices
+    data.release_split('train')
     database_labels = data.get_labels('train')
     for split in ['valid', 'test']:
         query = data.get_expression_mat(split)
-        query = embedder.predict(query)
+        query = transform_in_blocks(embedder.predict, query)
+        data.release_split(split)
         query_labels = data.get_labels(split)
         avg_map, wt_avg_map, avg_mafp, wt_avg_mafp = retrieval_test_in_memory(
-            database, database_labels, query, query_labels)
+            database, database_labels, query, query_labels, cache.get_siamese_cache(args))
         training_report['res_{}_avg_map'.format(split)] = avg_map
         training_report['res_{}_wt_avg_map'.format(split)] = wt_avg_map
         training_report['res_{}_avg_mafp'.format(split)] = avg_mafp
@@ -471,12 +523,9 @@ def train_neural_net(working_dir_path, args, data, training_report):
                     data=args.plotter,
                     out_dir=join(working_dir_path, 'pca_plotter'),
                     interval=args.plotter_int,
-                    sample_normalize=args.sn,
-                    feature_normalize=args.gn,
-                    feature_mean=data.mean,
-                    feature_std=data.std,
-                    minmax_normalize=args.mn,
-                    minmax_scaler=data.minmax_scaler
+                    normalizer=data.get_fitted_normalizer(),
+                    cache=data.cache,
+                    block_size=args.block_size
                 )
             )
         else:
@@ -486,14 +535,12 @@ def train_neural_net(working_dir_path, args, data, training_report):
                     data=args.plotter,
                     out_dir=join(working_dir_path, 'tsne_plotter'),
                     interval=args.plotter_int,
-                    sample_normalize=args.sn,
-                    feature_normalize=args.gn,
-                    feature_mean=data.mean,
-                    feature_std=data.std,
-                    minmax_normalize=args.mn,
-                    minmax_scaler=data.minmax_scaler
+                    normalizer=data.get_fitted_normalizer(),
+                    cache=data.cache,
+                    block_size=args.block_size
                 )
             )
+    share_splits(args, data, data.get_split_names())
     # Fit the model
     print('training model...')
     t0 = datetime.datetime.now()
@@ -576,6 +623,10 @@ def report_config(args, training_report):
         training_report['cfg_siam_unif_diff'] = args.unif_diff
         training_report['cfg_siam_same_lim'] = args.same_lim
         training_report['cfg_siam_diff_multiplier'] = args.diff_multiplier
+        training_report['cfg_siam_resample_pairs'] = 'Y' if args.resample_pairs else 'N'
+        if args.online_train:
+            training_report['cfg_siam_online_train'] = args.online_train
+            training_report['cfg_siam_hard_pair_frac'] = args.hard_pair_frac
         if args.dynMarginLoss:
             training_report['cfg_siam_pair_distances'] = args.dynMarginLoss
             training_report['cfg_siam_contrastive_margin'] = args.dynMargin
@@ -588,38 +639,31 @@ def report_config(args, training_report):
         training_report['cfg_triplet_P'] = args.batch_hard_P
         training_report['cfg_triplet_K'] = args.batch_hard_K
         training_report['cfg_triplet_batches'] = args.num_batches
+        training_report['cfg_triplet_mining'] = args.triplet_mining
 
 
 def load_data(args, working_dir):
     if args.layerwise_pt:
         data = DataContainer(
-            join(
-                args.data,
-                'unlabeled_data.h5'),
-            sample_normalize=args.sn,
-            feature_normalize=args.gn,
-            minmax_normalize=args.mn,
-            min=args.minmax_min,
-            max=args.minmax_max)
+            get_split_path(args.data, 'unlabeled_data'),
+            normalizer=normalization.Normalizer.from_args(args),
+            block_size=args.block_size,
+            cache=cache.get_preprocessed_cache(args),
+            as_sparse=args.sparse,
+            load_async=True)
     else:
         data = DataContainer(
-            join(
-                args.data,
-                'train_data.h5'),
-            sample_normalize=args.sn,
-            feature_normalize=args.gn,
-            minmax_normalize=args.mn,
-            min=args.minmax_min,
-            max=args.minmax_max)
-        data.add_split(join(args.data, 'valid_data.h5'), 'valid')
-        data.add_split(join(args.data, 'test_data.h5'), 'test')
-    if args.gn:
-        # save the training data mean and std for later use on new data
-        data.mean.to_pickle(join(working_dir, 'mean.p'))
-        data.std.to_pickle(join(working_dir, 'std.p'))
-    if args.mn:
-        with open(join(working_dir, 'minmax_scaler.p'), 'wb') as f:
-            pickle.dump(data.minmax_scaler, f)
+            get_split_path(args.data, 'train_data'),
+            normalizer=normalization.Normalizer.from_args(args),
+            block_size=args.block_size,
+            cache=cache.get_preprocessed_cache(args),
+            as_sparse=args.sparse,
+            load_async=True)
+        data.add_split(get_split_path(args.data, 'valid_data'), 'valid')
+        data.add_split(get_split_path(args.data, 'test_data'), 'test')
+    # save the normalization fitted on the training data for later use on new
+    # data, as soon as the train split is loaded
+    data.on_split_loaded('train', lambda: data.normalizer.save(working_dir))
     return data
 
 
@@ -636,6 +680,7 @@ def train(args: argparse.Namespace):
     training_report = {'cfg_type': model_type, 'cfg_folder': working_dir_path}
     report_config(args, training_report)
     print('loading data and setting up model...')
+    # Splits are loaded in the background, while the model is being set up
     data = load_data(args, working_dir_path)
     if args.pca:
         model = train_pca_model(working_dir_path, args, data)
@@ -0,0 +1,198 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from os import makedirs
+from os.path import abspath, exists, getsize, isdir, join
+
+DEFAULT_CACHE_ROOT = '_cache'
+PREPROCESSED_CACHE = 'preprocessed'
+SIAMESE_CACHE = 'siam_data'
+CACHE_NAMES = [PREPROCESSED_CACHE, SIAMESE_CACHE]
+LAST_ACCESS_FILE = '.last_access'
+HASH_MEMO_DIR = '.file_hashes'
+
+
+def hash_parts(*parts):
+    """A hex digest identifying a sequence of configuration values. Bytes are
+    hashed as is, anything else by its repr.
+    """
+    h = hashlib.sha1()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = repr(part).encode('utf-8')
+        h.update(hashlib.sha1(part).digest())
+    return h.hexdigest()
+
+
+def file_content_hash(path, chunk_size=2**24):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def dir_size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            total += getsize(join(dirpath, filename))
+    return total
+
+
+class CacheManager(object):
+    """A directory of cache entries, each one a folder named by a key (a hash
+    of everything the entry's content depends on), kept under max_bytes by
+    evicting the least recently used entries.
+    """
+    def __init__(self, root, max_bytes=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        makedirs(self.root, exist_ok=True)
+
+    def entry_path(self, key):
+        return join(self.root, key)
+
+    def content_hash(self, path):
+        """Content hash of a file. Hashing a multi-GB file takes a while, so
+        the result is memoized on the file's path, size and modification time.
+        """
+        stat = os.stat(path)
+        memo_dir = join(self.root, HASH_MEMO_DIR)
+        makedirs(memo_dir, exist_ok=True)
+        memo_file = join(memo_dir, hash_parts(abspath(path)) + '.json')
+        if exists(memo_file):
+            with open(memo_file) as f:
+                memo = json.load(f)
+            if memo['size'] == stat.st_size and memo['mtime_ns'] == stat.st_mtime_ns:
+                return memo['hash']
+        print("Hashing contents of ", path)
+        digest = file_content_hash(path)
+        tmp_file = '{}.{}.tmp'.format(memo_file, uuid.uuid4().hex)
+        with open(tmp_file, 'w') as f:
+            json.dump({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': digest}, f)
+        os.replace(tmp_file, memo_file)
+        return digest
+
+    def _touch(self, path):
+        with open(join(path, LAST_ACCESS_FILE), 'w') as f:
+            f.write(str(time.time()))
+
+    def get(self, key):
+        """Path to the entry for key, or None if it is not cached."""
+        path = self.entry_path(key)
+        if not isdir(path):
+            return None
+        self._touch(path)
+        return path
+
+    def put(self, key, write_fcn):
+        """Create the entry for key by calling write_fcn(folder), then evict
+        old entries if the cache is over budget. Returns the entry's path.
+        """
+        path = self.entry_path(key)
+        tmp_path = join(self.root, '.tmp-{}-{}'.format(key, uuid.uuid4().hex))
+        makedirs(tmp_path)
+        try:
+            write_fcn(tmp_path)
+            self._touch(tmp_path)
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another process finished writing the same entry first
+            if not isdir(path):
+                raise
+        finally:
+            if exists(tmp_path):
+                shutil.rmtree(tmp_path, ignore_errors=True)
+        self.evict(keep=key)
+        return path
+
+    def entries(self):
+        """(key, size in bytes, last access time) of every entry, least
+        recently used first.
+        """
+        entries = []
+        for name in os.listdir(self.root):
+            path = join(self.root, name)
+            if name.startswith('.') or not isdir(path):
+                continue
+            access_file = join(path, LAST_ACCESS_FILE)
+            last_access = os.stat(access_file).st_mtime if exists(access_file) else 0
+            entries.append((name, dir_size(path), last_access))
+        entries.sort(key=lambda entry: entry[2])
+        return entries
+
+    def remove(self, key):
+        shutil.rmtree(self.entry_path(key), ignore_errors=True)
+
+    def evict(self, max_bytes=None, keep=None):
+        """Remove least recently used entries until the cache fits in
+        max_bytes (defaults to the cache's budget). Returns the removed keys.
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        if max_bytes is None:
+            return []
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        removed = []
+        for key, size, _ in entries:
+            if total <= max_bytes:
+                break
+            if key == keep:
+                continue
+            print("Evicting cache entry ", key)
+            self.remove(key)
+            total -= size
+            removed.append(key)
+        return removed
+
+
+def get_preprocessed_cache(args):
+    """The cache of normalized expression matrices, if enabled on the command
+    line (see '--cache_dir').
+    """
+    cache_dir = getattr(args, 'cache_dir', None)
+    if cache_dir is None:
+        return None
+    return CacheManager(join(cache_dir, PREPROCESSED_CACHE), max_bytes=int(args.cache_size * 2**30))
+
+
+def get_siamese_cache(args):
+    """The cache of generated siamese pairs and compiled similarity matrices.
+    Unlike preprocessed matrices, these are always cached (under DEFAULT_CACHE_ROOT if '--cache_dir' is not
+    given).
+    """
+    cache_dir = getattr(args, 'cache_dir', None) or DEFAULT_CACHE_ROOT
+    return CacheManager(join(cache_dir, SIAMESE_CACHE), max_bytes=int(args.cache_size * 2**30))
+
+
+def format_size(n_bytes):
+    return "{:.1f} MB".format(n_bytes / 2**20)
+
+
+def manage_cache(args):
+    """Entry point of the 'cache' command: list, prune or clear the caches
+    in args.cache_dir.
+    """
+    names = CACHE_NAMES if args.which == 'all' else [args.which]
+    for name in names:
+        root = join(args.cache_dir, name)
+        if not isdir(root):
+            continue
+        manager = CacheManager(root)
+        if args.action == 'list':
+            entries = manager.entries()
+            print("{} ({} entries, {}):".format(root, len(entries), format_size(sum(size for _, size, _ in entries))))
+            for key, size, last_access in reversed(entries):
+                print("  {}  {:>10}  last used {}".format(key, format_size(size), time.strftime('%Y-%m-%d %H:%M', time.localtime(last_access))))
+        elif args.action == 'prune':
+            removed = manager.evict(max_bytes=int(args.max_size * 2**30))
+            print("Removed {} entries from {}".format(len(removed), root))
+        elif args.action == 'clear':
+            shutil.rmtree(root)
+            print("Removed ", root)
+
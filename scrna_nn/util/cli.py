@@ -6,6 +6,7 @@ from .. import reduce
 from .. import retrieval_test
 from .. import train
 from .. import visualize
+from . import cache
 
 
 def save_cmd_args_to_file(path):
@@ -30,12 +31,41 @@ def create_parser():
     common_options_parser.add_argument(
         "--data",
         help="Path to input data. For 'train' command, this must be a folder " +
-        "with train/valid/test files.",
+        "with train/valid/test files. Any of these may instead be a folder " +
+        "of per-study HDF5 shards (e.g. train_data/*.h5), which are read " +
+        "as one split.",
         required=False)
     common_options_parser.add_argument(
         "--out",
         help="Path to save output to. For training and retrieval this is a " +
         "folder path.")
+    common_options_parser.add_argument(
+        "--block_size",
+        help="Out-of-core mode: do not load the expression matrix into " +
+        "memory, read it lazily in blocks of this many rows (cells) instead. " +
+        "Peak memory is bounded by the block size rather than the dataset size.",
+        type=int,
+        default=None)
+    common_options_parser.add_argument(
+        "--sparse",
+        help="Keep expression matrices in a sparse (CSR) format. Minibatches " +
+        "are only made dense as they are fed to the model. " +
+        "Only compatible with '--sn' or no normalization.",
+        action="store_true")
+    common_options_parser.add_argument(
+        "--cache_dir",
+        help="Cache normalized expression matrices in this folder, keyed by " +
+        "the contents of the input file and the normalization settings. " +
+        "Repeat runs on the same data memory-map the cached matrix instead " +
+        "of re-parsing and re-normalizing the input. Disabled if not given. " +
+        "Siamese pairs are always cached, in this folder or in '_cache'.",
+        default=None)
+    common_options_parser.add_argument(
+        "--cache_size",
+        help="Maximum size of each cache, in GB. Least recently used entries " +
+        "are evicted beyond this.",
+        type=float,
+        default=50)
 
     # Add sub-commands
     subparsers = parser.add_subparsers(title="subcommands")
@@ -111,9 +141,17 @@ def create_parser():
     parser_train.add_argument(
         "--noise_level",
         help="Amount of corrupting noise to add to data " +
-        "(used for DAE training).",
+        "(used for DAE training and unsupervised pretraining, see --noise_type).",
         type=float,
         default=0.1)
+    parser_train.add_argument(
+        "--noise_type",
+        help="Type of corrupting noise for DAE training and unsupervised " +
+        "pretraining: gaussian (add noise with std noise_level) or dropout " +
+        "(zero out a noise_level fraction of the values). Noise is drawn " +
+        "anew for every minibatch.",
+        choices=['gaussian', 'dropout'],
+        default='gaussian')
     parser_train.add_argument(
         "--valid",
         help="The portion of the training data to set aside for validation." +
@@ -200,6 +238,22 @@ def create_parser():
         help="Number of batches per training epoch.",
         type=int,
         default=None)
+    group_opt.add_argument(
+        "--workers",
+        help="Number of workers that build minibatches in the background " +
+        "while the model trains on the current one. Every batch draws " +
+        "from its own random stream, so batches do not depend on this.",
+        type=int,
+        default=1)
+    group_opt.add_argument(
+        "--max_queue_size",
+        help="Number of minibatches the workers build ahead of training.",
+        type=int,
+        default=10)
+    group_opt.add_argument(
+        "--use_multiprocessing",
+        help="Use worker processes instead of threads to build minibatches.",
+        action="store_true")
     group_opt.add_argument("--opt", help="Optimizer to use.",
                            choices=[
                                "sgd",
@@ -281,6 +335,19 @@ def create_parser():
         "generate (diff_multiplier * same_count) pairs of different points.",
         type=int,
         default=2)
+    group_siam.add_argument(
+        "--pair_workers",
+        help="Number of processes that generate siamese pairs (each one " +
+        "handles a subset of the cell types). The generated pairs do not " +
+        "depend on this.",
+        type=int,
+        default=1)
+    group_siam.add_argument(
+        "--resample_pairs",
+        help="Draw a new set of training pairs every epoch (with the same " +
+        "'--same_lim', '--diff_multiplier' and '--unif_diff' composition), " +
+        "instead of generating one fixed set of pairs before training.",
+        action="store_true")
     group_siam.add_argument(
         "--dynMarginLoss",
         help="Use a dynamic-margin Contrastive Loss for the Siamese training " +
@@ -342,8 +409,30 @@ def create_parser():
     group_siam.add_argument(
         "--online_train",
         help="Dynamically generate hard pairs after n epochs for " +
-        "siamese neural network training.",
+        "siamese neural network training: every n epochs, the training " +
+        "set is embedded with the current network, and hard positives " +
+        "(far apart same pairs) and close negatives (nearest neighbours " +
+        "with a different label) are mined.",
         type=int)
+    group_siam.add_argument(
+        "--hard_pair_frac",
+        help="With '--online_train', the fraction of each training " +
+        "minibatch drawn from the mined hard pairs.",
+        type=float,
+        default=0.5)
+    group_siam.add_argument(
+        "--hard_pair_anchors",
+        help="With '--online_train', the number of random anchor samples " +
+        "to mine a hard positive and a close negative for.",
+        type=int,
+        default=10000)
+    group_siam.add_argument(
+        "--hard_pair_neighbors",
+        help="With '--online_train', the number of nearest neighbours " +
+        "searched for a close negative (and of same-label samples compared " +
+        "for a hard positive) per anchor.",
+        type=int,
+        default=10)
 
     group_trip = parser_train.add_argument_group('triplet networks')
     group_trip.add_argument(
@@ -381,6 +470,21 @@ def create_parser():
         "(number of samples from each class to pick).",
         type=int,
         default=4)
+    group_trip.add_argument(
+        "--triplet_mining",
+        help="Build training batches from classes whose centroids are " +
+        "close in the embedding of the whole training set (recomputed " +
+        "every '--triplet_mining_int' epochs). hard - each batch is a " +
+        "class and its P-1 nearest classes. semi-hard - the nearest classes " +
+        "that are farther than the class's own spread. none - random classes.",
+        choices=["none", "hard", "semi-hard"],
+        default="none")
+    group_trip.add_argument(
+        "--triplet_mining_int",
+        help="Interval for '--triplet_mining', re-embed the training set " +
+        "every n epochs.",
+        type=int,
+        default=1)
     group_trip.add_argument(
         "--num_batches",
         help="Number of batches to be drawn in an epoch.",
@@ -495,4 +599,32 @@ def create_parser():
         "database_data_file",
         help="Path to database samples (hdf5 dataframe).")
 
+    # cache
+    parser_cache = subparsers.add_parser(
+        "cache",
+        help="Inspect and prune the caches of preprocessed data and " +
+        "siamese pairs.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_cache.set_defaults(func=cache.manage_cache)
+    parser_cache.add_argument(
+        "action",
+        help="'list' the entries of each cache, 'prune' the least recently " +
+        "used entries until each cache fits in '--max_size', or 'clear' the " +
+        "caches entirely.",
+        choices=['list', 'prune', 'clear'])
+    parser_cache.add_argument(
+        "--cache_dir",
+        help="The cache folder (see '--cache_dir' of the other commands).",
+        default=cache.DEFAULT_CACHE_ROOT)
+    parser_cache.add_argument(
+        "--which",
+        help="Which cache to act on.",
+        choices=['all'] + cache.CACHE_NAMES,
+        default='all')
+    parser_cache.add_argument(
+        "--max_size",
+        help="For 'prune', the size (in GB) to shrink each cache to.",
+        type=float,
+        default=50)
+
     return parser
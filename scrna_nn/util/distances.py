@@ -1,11 +1,20 @@
 import math
 import pickle
+from os.path import join
 
+import numpy as np
+
+from .cache import hash_parts
 from .util import ScrnaException
 
+SIMILARITY_LABELS_FILE = 'similarity_labels.npy'
+SIMILARITY_RAW_FILE = 'similarity_raw.npy'
+SIMILARITY_FILE = 'similarity.npy'
+
 
 class PairSimilarity(object):
     def __init__(self, distance_mat_file, transform='linear', transform_param=None):
+        self.distance_mat_file = distance_mat_file
         with open(distance_mat_file, 'rb') as f:
             self.dist_mat = pickle.load(f)
         if transform not in ['linear', 'exponential', 'sigmoidal', 'binary']:
@@ -40,9 +49,51 @@ class PairSimilarity(object):
         else:
             return x
 
+    def _transform_array(self, x):
+        # Vectorized _transform, for a square matrix of similarities between
+        # labels (so label a == label b exactly on the diagonal)
+        if self.transform == 'exponential':
+            return (np.power(self.transform_param, x) - 1) / (self.transform_param - 1)
+        elif self.transform == 'sigmoidal':
+            return (1 - np.exp(-self.transform_param * x)) / (1 - math.exp(-self.transform_param))
+        elif self.transform == 'binary':
+            return np.where(np.isnan(x), np.nan, np.eye(x.shape[0]))
+        else:
+            return x
+
     def __call__(self, a, b, transform=True):
         raise NotImplementedError
 
+    def compile(self, labels):
+        """Look up the similarity between every pair of the given labels once,
+        and return them as a SimilarityMatrix indexed by label id (position
+        in labels). Pairs with no similarity information are NaN.
+        """
+        n_labels = len(labels)
+        raw = np.full((n_labels, n_labels), np.nan, dtype=np.float64)
+        for i, a in enumerate(labels):
+            raw[i, i] = 1.0
+            for j, b in enumerate(labels):
+                if i != j:
+                    try:
+                        raw[i, j] = self(a, b, transform=False)
+                    except KeyError:
+                        pass
+        return SimilarityMatrix(labels, raw.astype(np.float32), self._transform_array(raw).astype(np.float32))
+
+    def compile_cached(self, labels, similarity_cache):
+        """Same as compile, but the SimilarityMatrix is saved in
+        similarity_cache (a CacheManager) and memory-mapped from there.
+        """
+        key = hash_parts('similarity', type(self).__name__, similarity_cache.content_hash(self.distance_mat_file),
+                         self.transform, self.transform_param, getattr(self, 'max_dist', None),
+                         '\n'.join(np.asarray(labels).astype(str)))
+        path = similarity_cache.get(key)
+        if path is None:
+            print("Compiling similarities between {} labels".format(len(labels)))
+            path = similarity_cache.put(key, self.compile(labels).save)
+        return SimilarityMatrix.load(path)
+
 class OntologyBasedPairSimilarity(PairSimilarity):
     def __init__(self, max_ontology_distance, *args, **kwargs):
         self.max_dist = max_ontology_distance
@@ -64,6 +115,51 @@ class TextMinedPairSimilarity(PairSimilarity):
             return self._transform(sim, a, b)
         return sim
 
+class SimilarityMatrix(object):
+    """Raw and transformed similarities between labels, as (n_labels x
+    n_labels) float32 arrays indexed by label id.
+    """
+    def __init__(self, labels, raw, transformed, folder=None):
+        self.labels = np.asarray(labels)
+        self.label_to_int = {label: i for i, label in enumerate(self.labels)}
+        self.raw = raw
+        self.transformed = transformed
+        self.folder = folder
+
+    def __getstate__(self):
+        if self.folder is not None:
+            return {'folder': self.folder}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if 'raw' not in state:
+            state = SimilarityMatrix.load(state['folder']).__dict__
+        self.__dict__.update(state)
+
+    def label_ids(self, label_strings):
+        """Integer ids of an array of label strings."""
+        try:
+            return np.array([self.label_to_int[label] for label in label_strings], dtype=np.int32)
+        except KeyError as err:
+            raise ScrnaException("Label not in similarity matrix: {}".format(err))
+
+    def __call__(self, a_ids, b_ids, transform=True):
+        sim = self.transformed if transform else self.raw
+        return sim[a_ids, b_ids]
+
+    def save(self, folder):
+        np.save(join(folder, SIMILARITY_LABELS_FILE), self.labels.astype(str))
+        np.save(join(folder, SIMILARITY_RAW_FILE), self.raw)
+        np.save(join(folder, SIMILARITY_FILE), self.transformed)
+
+    @classmethod
+    def load(cls, folder, mmap_mode='r'):
+        return cls(np.load(join(folder, SIMILARITY_LABELS_FILE)),
+                   np.load(join(folder, SIMILARITY_RAW_FILE), mmap_mode=mmap_mode),
+                   np.load(join(folder, SIMILARITY_FILE), mmap_mode=mmap_mode),
+                   folder if mmap_mode is not None else None)
+
+
 def linear_decay(dist_in_ontology, lim=4):
     return max(0, 1 - (dist_in_ontology / lim))
 
@@ -1,6 +1,10 @@
 import argparse
 import sys
 import time
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
 from collections import defaultdict
 from os import makedirs
 from os.path import exists, join
@@ -17,6 +21,30 @@ def create_working_directory(out_path, parent, suffix=""):
         makedirs(out_path)
     return out_path
 
+def get_generator_options(args):
+    """Keyword arguments of fit_generator and evaluate_generator that set up
+    background building (prefetching) of minibatches.
+    """
+    return dict(workers=args.workers,
+                max_queue_size=args.max_queue_size,
+                use_multiprocessing=args.use_multiprocessing)
+
+def get_n_batch_buffers(args):
+    # Sequences reuse a batch's buffers this many batches later, by which
+    # time the batch must have been consumed
+    return args.workers + args.max_queue_size + 2
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB (None if it
+    cannot be determined on this platform).
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return round(max_rss / (1024 * 1024), 1) # reported in bytes
+    return round(max_rss / 1024, 1) # reported in kilobytes
+
 def build_indices_master_list(X, y):
     '''Builds a mapping of label (encoded as int) to a list
     of indices of training examples that have that label.
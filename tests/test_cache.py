@@ -0,0 +1,60 @@
+import os
+from os.path import exists, join
+
+import numpy as np
+import pytest
+
+from scrna_nn.util.cache import CacheManager, LAST_ACCESS_FILE
+
+
+def write_bytes(n_bytes):
+    def write(folder):
+        with open(join(folder, 'data.bin'), 'wb') as f:
+            f.write(b'\0' * n_bytes)
+    return write
+
+
+def set_last_access(cache, key, when):
+    os.utime(join(cache.entry_path(key), LAST_ACCESS_FILE), (when, when))
+
+
+def test_put_then_get(tmpdir):
+    cache = CacheManager(str(tmpdir))
+    assert cache.get('a') is None
+    path = cache.put('a', lambda folder: np.save(join(folder, 'x.npy'), np.arange(5)))
+    assert cache.get('a') == path
+    np.testing.assert_array_equal(np.load(join(path, 'x.npy')), np.arange(5))
+    # No temporary folders are left behind
+    assert sorted(os.listdir(str(tmpdir))) == ['a']
+
+
+def test_evicts_least_recently_used(tmpdir):
+    cache = CacheManager(str(tmpdir), max_bytes=2500)
+    cache.put('old', write_bytes(1000))
+    cache.put('used', write_bytes(1000))
+    set_last_access(cache, 'old', 1000)
+    set_last_access(cache, 'used', 2000)
+    cache.put('new', write_bytes(1000))
+    assert cache.get('old') is None
+    assert cache.get('used') is not None
+    assert cache.get('new') is not None
+
+
+def test_keeps_the_new_entry_over_budget(tmpdir):
+    cache = CacheManager(str(tmpdir), max_bytes=500)
+    cache.put('small', write_bytes(100))
+    path = cache.put('big', write_bytes(1000))
+    assert exists(path)
+    assert cache.get('small') is None
+    assert [key for key, _, _ in cache.entries()] == ['big']
+
+
+def test_failed_write_leaves_no_entry(tmpdir):
+    cache = CacheManager(str(tmpdir))
+
+    def fail(folder):
+        raise ValueError("write failed")
+    with pytest.raises(ValueError):
+        cache.put('a', fail)
+    assert cache.get('a') is None
+    assert os.listdir(str(tmpdir)) == []
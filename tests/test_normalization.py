@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.preprocessing import MinMaxScaler
+
+from scrna_nn.data_manipulation.normalization import Normalizer, RunningMoments, iter_row_chunks
+
+EPS = np.finfo(np.float32).eps
+
+
+@pytest.fixture
+def expression_df():
+    rng = np.random.RandomState(0)
+    X = rng.lognormal(size=(103, 7)).astype(np.float32)
+    X[:, 3] = 2.5 # a constant gene
+    return pd.DataFrame(X)
+
+
+def test_running_moments_match_pandas(expression_df):
+    moments = RunningMoments(expression_df.shape[1])
+    for chunk in iter_row_chunks(expression_df.values, 10):
+        moments.update(chunk)
+    assert moments.count == len(expression_df)
+    np.testing.assert_allclose(moments.mean, expression_df.mean(), rtol=1e-6)
+    np.testing.assert_allclose(moments.std, expression_df.std(ddof=0), rtol=1e-5, atol=1e-6)
+
+
+def test_sample_normalization_matches_pandas(expression_df):
+    expected = expression_df.div(expression_df.sum(axis=1) + EPS, axis=0)
+    X = Normalizer('sn').transform(expression_df.values.copy(), chunk_rows=10)
+    np.testing.assert_allclose(X, expected.values, rtol=1e-6)
+
+
+def test_gene_normalization_matches_pandas(expression_df):
+    expected = (expression_df - expression_df.mean()) / (expression_df.std(ddof=0) + EPS)
+    normalizer = Normalizer('gn').fit(iter_row_chunks(expression_df.values, 10))
+    X = normalizer.transform(expression_df.values.copy(), chunk_rows=10)
+    np.testing.assert_allclose(X, expected.values, rtol=1e-4, atol=1e-4)
+
+
+def test_minmax_normalization_matches_sklearn(expression_df):
+    expected = MinMaxScaler(feature_range=(-1, 1)).fit_transform(expression_df.values)
+    normalizer = Normalizer('mn', (-1, 1)).fit(iter_row_chunks(expression_df.values, 10))
+    X = normalizer.transform(expression_df.values.copy(), chunk_rows=10)
+    np.testing.assert_allclose(X, expected, rtol=1e-5, atol=1e-5)
+
+
+def test_saved_normalizer_transforms_the_same(expression_df, tmpdir):
+    normalizer = Normalizer('gn').fit([expression_df.values])
+    normalizer.save(str(tmpdir))
+    loaded = Normalizer.load(str(tmpdir))
+    np.testing.assert_array_equal(loaded.transform(expression_df.values.copy()),
+                                  normalizer.transform(expression_df.values.copy()))
@@ -0,0 +1,102 @@
+import multiprocessing
+import pickle
+from os.path import join
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from scrna_nn.data_manipulation import shared
+from scrna_nn.data_manipulation.row_blocks import (RowBlockMatrix, ShardedRowMatrix, read_expression_mat,
+                                                   read_sharded_expression_mat)
+
+SHARD_ROWS = [7, 1, 12]
+N_COLS = 5
+
+
+@pytest.fixture
+def shards(tmpdir):
+    """Paths of a split stored as HDF5 shards, and the expected matrix."""
+    rng = np.random.RandomState(0)
+    paths, frames = [], []
+    for i, n_rows in enumerate(SHARD_ROWS):
+        values = rng.rand(n_rows, N_COLS)
+        values[rng.rand(n_rows, N_COLS) < 0.2] = np.nan
+        df = pd.DataFrame(values, index=['cell{}_{}'.format(i, j) for j in range(n_rows)],
+                          columns=['gene{}'.format(j) for j in range(N_COLS)])
+        paths.append(join(str(tmpdir), 'shard{}.h5'.format(i)))
+        df.to_hdf(paths[-1], key='rpkm')
+        frames.append(df)
+    expected = pd.concat(frames).fillna(0).values.astype(np.float32)
+    return paths, expected
+
+
+@pytest.fixture(params=[1, 4], ids=['in_process', 'processes'])
+def n_readers(request, monkeypatch):
+    # Read in spawned processes even on a single CPU
+    monkeypatch.setattr(multiprocessing, 'cpu_count', lambda: 4)
+    return request.param
+
+
+@pytest.mark.parametrize('block_size', [3, 100])
+def test_sharded_take(shards, block_size):
+    paths, expected = shards
+    X = ShardedRowMatrix(paths, block_size=block_size, max_cached_blocks=1)
+    assert X.shape == expected.shape
+    rows = np.array([0, 19, 7, 8, 3, 7, -1, 7, 12])
+    np.testing.assert_array_equal(X.take(rows), expected[rows])
+    np.testing.assert_array_equal(X[2:16:3], expected[2:16:3])
+    np.testing.assert_array_equal(X.to_array(), expected)
+    X.close()
+
+
+def test_sharded_take_after_pickling(shards):
+    paths, expected = shards
+    X = ShardedRowMatrix(paths, block_size=4)
+    X.take([0, 10])
+    restored = pickle.loads(pickle.dumps(X))
+    X.close()
+    np.testing.assert_array_equal(restored.take([15, 0, 7]), expected[[15, 0, 7]])
+    restored.close()
+
+
+def test_transform_is_applied_to_every_shard(shards):
+    paths, expected = shards
+    X = ShardedRowMatrix(paths, block_size=4, transform=lambda block: block * 2)
+    np.testing.assert_array_equal(X.take([1, 7, 19]), 2 * expected[[1, 7, 19]])
+    X.close()
+
+
+def test_read_sharded(shards, n_readers):
+    paths, expected = shards
+    X, index, columns = read_sharded_expression_mat(paths, chunk_rows=4, n_readers=n_readers)
+    np.testing.assert_array_equal(X, expected)
+    assert len(index) == len(expected) and len(columns) == N_COLS
+    X_sparse, _, _ = read_sharded_expression_mat(paths, chunk_rows=4, as_sparse=True, n_readers=n_readers)
+    np.testing.assert_array_equal(X_sparse.toarray(), expected)
+
+
+def test_read_row_ranges(shards, n_readers):
+    paths, expected = shards
+    X, _, _ = read_expression_mat(paths[2], chunk_rows=5, n_readers=n_readers)
+    np.testing.assert_array_equal(X, expected[-SHARD_ROWS[2]:])
+    X_sparse, _, _ = read_expression_mat(paths[2], chunk_rows=5, as_sparse=True, n_readers=n_readers)
+    np.testing.assert_array_equal(X_sparse.toarray(), expected[-SHARD_ROWS[2]:])
+
+
+def test_row_block_matrix_take(shards):
+    paths, expected = shards
+    X = RowBlockMatrix(paths[2], block_size=5, max_cached_blocks=1)
+    rows = np.array([11, 0, 5, 5, 4])
+    np.testing.assert_array_equal(X.take(rows), expected[SHARD_ROWS[0] + SHARD_ROWS[1] + rows])
+    X.close()
+
+
+def test_shared_matrix_handle():
+    X = shared.from_array(np.arange(12, dtype=np.float32).reshape(4, 3))
+    handle = shared.get_handle(X)
+    attached = shared.attach(handle, mode='r+')
+    attached[1] = -1
+    np.testing.assert_array_equal(X[1], -1)
+    assert shared.get_handle(np.zeros(3)) is None
+    assert shared.get_handle(X[:, 1:]) is None
@@ -0,0 +1,17 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+
+from scrna_nn.data_manipulation.data_container import DenoisingSequence
+
+
+def test_denoising_targets_survive_prefetching():
+    # Hold on to more batches than the default number of buffers, as
+    # fit_generator's workers and queue do
+    X = np.arange(200 * 3, dtype=np.float32).reshape(200, 3)
+    n_held = 10
+    sequence = DenoisingSequence(X, 4, "train", 'gaussian', 0, n_buffers=n_held + 2)
+    batches = [sequence[idx] for idx in range(n_held)]
+    for noisy, clean in batches:
+        np.testing.assert_array_equal(noisy, clean)
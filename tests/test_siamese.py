@@ -0,0 +1,99 @@
+import pickle
+from argparse import Namespace
+from os.path import join
+
+import numpy as np
+import pytest
+
+from scrna_nn.data_manipulation import siamese
+from scrna_nn.util.distances import SimilarityMatrix
+
+LABELS = ['a', 'b', 'c', 'd']
+SIMILARITIES = {'a': {'b': 0.9, 'c': 0.5, 'd': 0.1},
+                'b': {'a': 0.9, 'c': 0.4, 'd': 0.2},
+                'c': {'a': 0.5, 'b': 0.4, 'd': 0.6},
+                'd': {'a': 0.1, 'b': 0.2, 'c': 0.6}}
+
+
+def make_similarity():
+    raw = np.array([[1.0 if a == b else SIMILARITIES[a][b] for b in LABELS] for a in LABELS], dtype=np.float32)
+    return SimilarityMatrix(LABELS, raw, raw.copy())
+
+
+def make_args(tmpdir, unif_diff=0):
+    dist_mat_file = join(str(tmpdir), 'similarities.p')
+    with open(dist_mat_file, 'wb') as f:
+        pickle.dump(SIMILARITIES, f)
+    return Namespace(dynMarginLoss='text-mined', dist_mat_file=dist_mat_file, trnsfm_fcn='linear',
+                     trnsfm_fcn_param=None, same_lim=20, unif_diff=unif_diff, diff_multiplier=2,
+                     cache_dir=str(tmpdir), cache_size=1)
+
+
+def make_samples(rng):
+    y = np.repeat(np.arange(len(LABELS)), [6, 8, 5, 7])
+    # Some neighbouring cells are the same underlying sample
+    true_ids = np.arange(len(y))
+    true_ids[1::6] = true_ids[0::6][:len(true_ids[1::6])]
+    order = rng.permutation(len(y))
+    return y[order], true_ids[order]
+
+
+def check_pairs(pairs, sims, y, true_ids, similarity):
+    same = y[pairs[:, 0]] == y[pairs[:, 1]]
+    np.testing.assert_array_equal(sims[same], 1)
+    np.testing.assert_array_equal(sims[~same], similarity.transformed[y[pairs[~same, 0]], y[pairs[~same, 1]]])
+    assert (pairs[:, 0] != pairs[:, 1]).all()
+    assert (true_ids[pairs[~same, 0]] != true_ids[pairs[~same, 1]]).all()
+
+
+def anchor_label_counts(pairs, y):
+    """Number of (same, different) pairs of every anchor label."""
+    same = y[pairs[:, 0]] == y[pairs[:, 1]]
+    return np.stack([np.bincount(y[pairs[same, 0]], minlength=len(LABELS)),
+                     np.bincount(y[pairs[~same, 0]], minlength=len(LABELS))])
+
+
+@pytest.mark.parametrize('unif_diff', [0, 2])
+@pytest.mark.parametrize('n_workers', [1, 2])
+def test_flexible_pairs(tmpdir, unif_diff, n_workers):
+    y, true_ids = make_samples(np.random.RandomState(0))
+    X = np.zeros((len(y), 3), dtype=np.float32)
+    args = make_args(tmpdir, unif_diff)
+    pairs, sims = siamese.create_flexible_data_pairs(X, y, true_ids, LABELS, args, n_workers)
+    check_pairs(pairs, sims, y, true_ids, make_similarity())
+    # Every anchor label gets min(same_lim, its number of combinations) same-pairs
+    counts = np.bincount(y)
+    np.testing.assert_array_equal(anchor_label_counts(pairs, y)[0], np.minimum(counts * (counts - 1) // 2, args.same_lim))
+
+
+@pytest.mark.parametrize('unif_diff', [0, 2])
+def test_pair_sampler_matches_flexible_pairs(tmpdir, unif_diff):
+    y, true_ids = make_samples(np.random.RandomState(1))
+    similarity = make_similarity()
+    args = make_args(tmpdir, unif_diff)
+    sampler = siamese.PairSampler(y, true_ids, similarity, args)
+    pairs, sims = sampler.draw_epoch(np.random.RandomState(2))
+    check_pairs(pairs, sims, y, true_ids, similarity)
+    # Same number of same-pairs and different-pairs per anchor label
+    expected, _ = siamese.create_flexible_data_pairs(np.zeros((len(y), 1)), y, true_ids, LABELS, args)
+    np.testing.assert_array_equal(anchor_label_counts(pairs, y), anchor_label_counts(expected, y))
+
+
+def test_pair_sampler_draws_are_reproducible(tmpdir):
+    y, true_ids = make_samples(np.random.RandomState(3))
+    sampler = siamese.PairSampler(y, true_ids, make_similarity(), make_args(tmpdir))
+    first = sampler.draw(slice(0, 10), np.random.RandomState(4))
+    second = sampler.draw(slice(0, 10), np.random.RandomState(4))
+    np.testing.assert_array_equal(first[0], second[0])
+    np.testing.assert_array_equal(first[1], second[1])
+
+
+def test_mix_in_pairs():
+    batch_pairs = np.zeros((10, 2), dtype=np.int32)
+    batch_y = np.zeros(10, dtype=np.float32)
+    extra_pairs = np.ones((3, 2), dtype=np.int32)
+    extra_y = np.ones(3, dtype=np.float32)
+    pairs, sims = siamese.mix_in_pairs(batch_pairs, batch_y, extra_pairs, extra_y, 0.3, np.random.RandomState(0))
+    assert pairs.shape == batch_pairs.shape
+    assert (pairs == 1).all(axis=1).sum() == 3
+    assert sims.sum() == 3
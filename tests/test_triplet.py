@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+
+from scrna_nn.neural_network.triplet import MinedTripletSequence
+
+
+@pytest.mark.parametrize('mining', ['hard', 'semi-hard'])
+def test_identity_is_not_its_own_neighbour(mining):
+    rng = np.random.RandomState(0)
+    n_ids, samples_per_id = 12, 5
+    y = np.repeat(np.arange(n_ids), samples_per_id)
+    # Identities whose spread is much larger than the distances between
+    # their centroids, so every other identity is "too close"
+    embeddings = np.repeat(rng.normal(size=(n_ids, 2)), samples_per_id, axis=0) \
+        + 10 * rng.normal(size=(len(y), 2))
+    sequence = MinedTripletSequence(embeddings, y, ids_per_batch=4, samples_per_id=2,
+                                    num_batches=5, mining=mining)
+    sequence.refresh(embeddings)
+    assert not (sequence.neighbour_ids == np.arange(n_ids)[:, None]).any()
+    for idx in range(len(sequence)):
+        _, batch_y = sequence[idx]
+        assert len(np.unique(batch_y)) == sequence.ids_per_batch